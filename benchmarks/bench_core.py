@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Benchmark the core pair engine on synthetic trees.
+
+For every combination of tree shape and size a seeded random tree and a
+matching database are generated (see treegen.py). Every measured operation
+runs in a fresh child process, so that the reported peak memory is not
+distorted by earlier runs. Results are written as JSON, e.g.::
+
+    python benchmarks/bench_core.py --sizes 1000 10000 -o bench.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+import treegen
+
+from phylabelle import __version__
+from phylabelle.core import PhyloTree
+
+#: stack size for the evaluation thread, deep (caterpillar) trees need a lot
+#: of it, because PhyloTree.evaluate is recursive
+THREAD_STACK_SIZE = 512 * 1024 * 1024
+
+
+def max_rss():
+    """
+    :return int: peak resident set size of the current process in kB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def count_pairs(results):
+    try:
+        return len(results)
+    except TypeError:
+        return None
+
+
+def run_operation(tree_file, db_file, operation, threshold, queries, mode, top_k):
+    """
+    load the tree and execute one operation; runs inside the child process
+    :return dict: measurements
+    """
+    session = treegen.open_session(db_file)
+
+    start = time.time()
+    phylo_tree = PhyloTree(tree_file, session=session)
+    load_wall = time.time() - start
+
+    if operation in ('get_closest', 'get_minimum_matching'):
+        phylo_tree.evaluate_all_pairs(threshold, mode=mode)
+
+    rss_before = max_rss()
+    wall = time.time()
+    cpu = time.clock()
+
+    if operation == 'evaluate_all_pairs':
+        phylo_tree.evaluate_all_pairs(threshold, mode=mode)
+        n_pairs = phylo_tree.results.number_of_edges()
+    elif operation == 'evaluate_top_pairs':
+        phylo_tree.evaluate_top_pairs(top_k, threshold, mode=mode)
+        n_pairs = phylo_tree.results.number_of_edges()
+    elif operation == 'get_closest':
+        n_pairs = count_pairs(phylo_tree.get_closest())
+    elif operation == 'get_minimum_matching':
+        n_pairs = count_pairs(phylo_tree.get_minimum_matching())
+    elif operation == 'find_closest_partner':
+        n_pairs = 0
+        for query in queries:
+            n_pairs += count_pairs(phylo_tree.find_closest_partner(query, mode=mode))
+    else:
+        raise ValueError('unknown operation {}'.format(operation))
+
+    return {
+        'load_wall': load_wall,
+        'wall': time.time() - wall,
+        'cpu': time.clock() - cpu,
+        'rss_before_kb': rss_before,
+        'peak_rss_kb': max_rss(),
+        'n_pairs': n_pairs,
+    }
+
+
+def _child(conn, recursion_limit, args):
+    """
+    entry point of the child process, runs the operation in a thread with a
+    large stack and sends the result through conn
+    """
+    result = {}
+
+    def target():
+        try:
+            result.update(run_operation(*args))
+        except Exception:
+            result['error'] = traceback.format_exc()
+
+    sys.setrecursionlimit(recursion_limit)
+    threading.stack_size(THREAD_STACK_SIZE)
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+
+    conn.send(result)
+    conn.close()
+
+
+def measure(tree_file, db_file, depth, operation, threshold, queries, mode, top_k):
+    """
+    run one operation in a child process
+    :return dict: measurements, or a dict containing the key 'error'
+    """
+    parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    recursion_limit = max(sys.getrecursionlimit(), 4 * depth + 1000)
+    proc = multiprocessing.Process(target=_child, args=(
+        child_conn, recursion_limit,
+        (tree_file, db_file, operation, threshold, queries, mode, top_k)))
+    proc.start()
+    child_conn.close()
+
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = {}
+    proc.join()
+
+    if proc.exitcode != 0:
+        result['error'] = 'child process exited with code {}'.format(proc.exitcode)
+
+    return result
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shapes', nargs='+', default=treegen.SHAPES,
+                        choices=treegen.SHAPES, help='tree shapes')
+    parser.add_argument('--sizes', nargs='+', type=int,
+                        default=[1000, 10000, 100000, 1000000],
+                        help='number of leaves')
+    parser.add_argument('--thresholds', nargs='+', type=float,
+                        default=[0.05, 0.1, 0.2],
+                        help='distance thresholds for evaluate_all_pairs')
+    parser.add_argument('--matching-threshold', type=float, default=0.1,
+                        help='threshold for the evaluation preceding '
+                             'get_closest and get_minimum_matching')
+    parser.add_argument('--queries', type=int, default=10,
+                        help='number of query leaves for find_closest_partner')
+    parser.add_argument('--top', type=int, default=100,
+                        help='number of pairs for evaluate_top_pairs, which runs '
+                             'with every threshold')
+    parser.add_argument('--label-ratio', type=float, default=0.5,
+                        help='fraction of positively labeled leaves')
+    parser.add_argument('--species-ratio', type=float, default=0.05,
+                        help='number of species per leaf')
+    parser.add_argument('-m', '--mode', default='all',
+                        choices=['all', 'inter', 'intra'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', default='-',
+                        help='JSON output file, "-" for stdout')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+
+    report = {
+        'meta': {
+            'phylabelle': __version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'seed': args.seed,
+            'label_ratio': args.label_ratio,
+            'species_ratio': args.species_ratio,
+            'mode': args.mode,
+            'top': args.top,
+        },
+        'results': [],
+    }
+
+    work_dir = tempfile.mkdtemp(prefix='phylabelle_bench_')
+
+    try:
+        for shape in args.shapes:
+            for size in args.sizes:
+                tree_file = os.path.join(work_dir, '{}_{}.nwk'.format(shape, size))
+                db_file = os.path.join(work_dir, '{}_{}.db'.format(shape, size))
+
+                start = time.time()
+                tree = treegen.SyntheticTree(size, shape=shape, seed=args.seed)
+                tree.write_newick(tree_file)
+                treegen.populate_database(tree, db_file, label_ratio=args.label_ratio,
+                                          species_ratio=args.species_ratio, seed=args.seed)
+                depth = tree.depth()
+                generation = time.time() - start
+
+                rand = random.Random(args.seed)
+                queries = [treegen.leaf_name(rand.randrange(size))
+                           for _ in xrange(args.queries)]
+                del tree
+
+                runs = [('evaluate_all_pairs', t) for t in args.thresholds]
+                runs += [('evaluate_top_pairs', t) for t in args.thresholds]
+                runs += [('get_closest', args.matching_threshold),
+                         ('get_minimum_matching', args.matching_threshold),
+                         ('find_closest_partner', None)]
+
+                for operation, threshold in runs:
+                    result = measure(tree_file, db_file, depth, operation,
+                                     threshold, queries, args.mode, args.top)
+                    result.update({
+                        'shape': shape,
+                        'leaves': size,
+                        'depth': depth,
+                        'generation_wall': generation,
+                        'operation': operation,
+                        'threshold': threshold,
+                    })
+                    report['results'].append(result)
+
+                    sys.stderr.write('{:12} {:>8} {:22} {:>6} {}\n'.format(
+                        shape, size, operation, threshold,
+                        'error' if 'error' in result else '{:.3f}s'.format(result['wall'])))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
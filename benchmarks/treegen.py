@@ -0,0 +1,214 @@
+# coding: utf-8
+"""
+Synthetic trees
+===============
+
+Seeded generator for random phylogenetic trees and a matching phylabelle
+database, used by the benchmark suite. Trees are built as flat child lists and
+written as newick without recursion, so that caterpillar trees with a million
+leaves can be produced as well.
+
+Supported shapes:
+
+* ``balanced``: every inner node splits its leaf set in halves
+* ``caterpillar``: every inner node has one leaf and one inner child
+* ``bootstrap``: random coalescent-like merging with bootstrap support values,
+  which resembles the shape of real-world consensus trees
+"""
+
+import os
+import random
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from phylabelle import orm
+
+SHAPES = ['balanced', 'caterpillar', 'bootstrap']
+
+
+def leaf_name(i):
+    """
+    :param int i: leaf number
+    :return str: assembly accession like leaf name
+    """
+    return 'GCA_{:09d}.1'.format(i)
+
+
+class SyntheticTree(object):
+    """
+    Random rooted binary tree. Node ``0`` to ``n_leaves - 1`` are leaves, the
+    root is the last node.
+    """
+    def __init__(self, n_leaves, shape='balanced', seed=0, mean_branch_length=0.05):
+        """
+        :param int n_leaves: number of leaves, at least 2
+        :param str shape: one of SHAPES
+        :param int seed: random seed
+        :param float mean_branch_length: mean of the exponentially distributed
+                                         branch lengths
+        """
+        assert shape in SHAPES, 'unknown shape {}'.format(shape)
+        assert n_leaves > 1, 'a tree needs at least 2 leaves'
+
+        self.n_leaves = n_leaves
+        self.shape = shape
+        self.seed = seed
+        self.rand = random.Random(seed)
+        self.mean_branch_length = mean_branch_length
+
+        self.children = [None] * n_leaves
+        self.dist = [self._branch_length() for _ in xrange(n_leaves)]
+        self.support = [None] * n_leaves
+
+        getattr(self, '_build_{}'.format(shape))()
+        self.root = len(self.children) - 1
+
+    def _branch_length(self):
+        return self.rand.expovariate(1. / self.mean_branch_length)
+
+    def _join(self, nodes, support=None):
+        """
+        add a new inner node with the given children
+        :return int: id of new node
+        """
+        self.children.append(nodes)
+        self.dist.append(self._branch_length())
+        self.support.append(support)
+        return len(self.children) - 1
+
+    def _build_balanced(self):
+        level = range(self.n_leaves)
+        while len(level) > 1:
+            next_level = [self._join([level[i], level[i + 1]])
+                          for i in xrange(0, len(level) - 1, 2)]
+            if len(level) % 2:
+                next_level.append(level[-1])
+            level = next_level
+
+    def _build_caterpillar(self):
+        node = self._join([0, 1])
+        for leaf in xrange(2, self.n_leaves):
+            node = self._join([node, leaf])
+
+    def _build_bootstrap(self):
+        pool = range(self.n_leaves)
+        while len(pool) > 1:
+            # draw two random subtrees, swap-pop keeps this O(1) per merge
+            i = self.rand.randrange(len(pool))
+            pool[i], pool[-1] = pool[-1], pool[i]
+            first = pool.pop()
+            j = self.rand.randrange(len(pool))
+            pool[j], pool[-1] = pool[-1], pool[j]
+            second = pool.pop()
+            support = min(100, int(self.rand.betavariate(5, 1) * 101))
+            pool.append(self._join([first, second], support=support))
+
+    def leaf_order(self):
+        """
+        iterate over leaf ids in newick (depth first) order
+        """
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if self.children[node] is None:
+                yield node
+            else:
+                stack.extend(reversed(self.children[node]))
+
+    def depth(self):
+        """
+        :return int: maximum number of edges between root and any leaf
+        """
+        max_depth = 0
+        stack = [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            max_depth = max(max_depth, depth)
+            if self.children[node] is not None:
+                stack.extend((child, depth + 1) for child in self.children[node])
+        return max_depth
+
+    def write_newick(self, path):
+        """
+        write tree in newick format (with support values for inner nodes)
+        :param str path: target file
+        """
+        parts = []
+        # explicit stack of (token, node) instead of recursion, tokens are
+        # 'node', ',' and ')'
+        stack = [('node', self.root)]
+        while stack:
+            token, node = stack.pop()
+            if token == ',':
+                parts.append(',')
+            elif token == ')':
+                parts.append(')')
+                if self.support[node] is not None:
+                    parts.append(str(self.support[node]))
+                if node != self.root:
+                    parts.append(':{:.6f}'.format(self.dist[node]))
+            elif self.children[node] is None:
+                parts.append('{}:{:.6f}'.format(leaf_name(node), self.dist[node]))
+            else:
+                parts.append('(')
+                stack.append((')', node))
+                children = self.children[node]
+                for k, child in enumerate(reversed(children)):
+                    if k > 0:
+                        stack.append((',', None))
+                    stack.append(('node', child))
+
+        with open(path, 'w') as f:
+            f.write(''.join(parts))
+            f.write(';\n')
+
+
+def populate_database(tree, db_file, label_ratio=0.5, species_ratio=0.05, seed=0):
+    """
+    create a phylabelle database holding one assembly per leaf of tree.
+    Species are assigned to runs of neighbouring leaves, so that species
+    form clades like they would in a real phylogeny.
+    :param SyntheticTree tree:
+    :param str db_file: path of the sqlite file to create
+    :param float label_ratio: fraction of positively labeled leaves
+    :param float species_ratio: number of species per leaf
+    :param int seed: random seed
+    """
+    rand = random.Random(seed)
+
+    if os.path.isfile(db_file):
+        os.remove(db_file)
+
+    engine = create_engine('sqlite:///{}'.format(db_file), echo=False)
+    orm.Base.metadata.create_all(engine)
+
+    n_species = max(1, int(tree.n_leaves * species_ratio))
+    run_length = max(1, tree.n_leaves // n_species)
+
+    rows = []
+    for i, leaf in enumerate(tree.leaf_order()):
+        species = min(i // run_length, n_species - 1)
+        rows.append({
+            'accession': leaf_name(leaf),
+            'label': rand.random() < label_ratio,
+            'species_tax_id': str(species),
+            'species_name': 'species {}'.format(species),
+            'organism_name': 'species {} strain {}'.format(species, leaf),
+            'infraspecific_name': 'strain={}'.format(leaf),
+        })
+
+    with engine.begin() as conn:
+        for start in xrange(0, len(rows), 10000):
+            conn.execute(orm.assemblies.insert(), rows[start:start + 10000])
+
+    engine.dispose()
+
+
+def open_session(db_file):
+    """
+    :param str db_file: path of a database created by populate_database
+    :return: sqlalchemy session
+    """
+    engine = create_engine('sqlite:///{}'.format(db_file), echo=False)
+    return sessionmaker(bind=engine)()
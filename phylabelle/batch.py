@@ -0,0 +1,158 @@
+# coding: utf-8
+"""
+phylabelle.batch
+================
+
+Evaluate several trees (e.g. bootstrap replicates) in parallel worker
+processes and aggregate the pairs found in each of them.
+
+The database is read once in the parent process. Worker processes are forked
+afterwards and inherit the loaded data, so they never touch the database
+themselves and only send back plain ``(accession1, accession2, distance)``
+tuples.
+"""
+
+import multiprocessing
+import warnings
+
+from phylabelle.core import PhyloTree
+from phylabelle.orm import Assembly
+from phylabelle.profiling import NullProfiler
+
+#: data shared with forked worker processes, set by TreeBatch.run
+_shared = {}
+
+
+def _evaluate_tree(tree_file):
+    """
+    evaluate a single tree; runs inside a worker process
+    :param str tree_file: path to tree file
+    :return tuple: (tree_file, list of pairs or None, error message or None)
+    """
+    try:
+        phylo_tree = PhyloTree(tree_file, session=None,
+                               species_index=_shared['species_index'],
+                               assemblies=_shared['assemblies'])
+    except (AssertionError, ValueError) as e:
+        return tree_file, None, str(e)
+
+    phylo_tree.evaluate_all_pairs(_shared['threshold'], mode=_shared['mode'])
+
+    if _shared['matching']:
+        pairs = list(phylo_tree.results.get_minimum_matching())
+    else:
+        pairs = list(phylo_tree.results.get_closest())
+
+    return tree_file, pairs, None
+
+
+class PairSupport(object):
+    """
+    Aggregates pairs over several trees: how often a pair was found, and the
+    mean and variance of its distance.
+    """
+    def __init__(self):
+        self.n_trees = 0
+        #: (accession1, accession2) -> [count, sum of distances, sum of squared distances]
+        self._stats = {}
+
+    def add_tree(self, pairs):
+        """
+        :param iterable pairs: tuples (accession1, accession2, distance) found in one tree
+        """
+        self.n_trees += 1
+        for acc1, acc2, dist in pairs:
+            key = (acc1, acc2) if acc1 < acc2 else (acc2, acc1)
+            try:
+                stats = self._stats[key]
+            except KeyError:
+                stats = self._stats[key] = [0, 0., 0.]
+            stats[0] += 1
+            stats[1] += dist
+            stats[2] += dist * dist
+
+    def __len__(self):
+        return len(self._stats)
+
+    def __iter__(self):
+        """
+        :yield tuple: (accession1, accession2, support, mean distance, variance),
+                      where support is the fraction of trees containing the pair
+                      and variance is the sample variance of the distance
+        """
+        for (acc1, acc2), (count, sum_, sum_sq) in self._stats.iteritems():
+            mean = sum_ / count
+            if count > 1:
+                variance = max(0., (sum_sq - count * mean * mean) / (count - 1))
+            else:
+                variance = 0.
+            yield acc1, acc2, float(count) / self.n_trees, mean, variance
+
+
+class TreeBatch(object):
+    """
+    Evaluates a list of trees against one set of assemblies.
+    """
+    def __init__(self, tree_files, session, n_proc=2, profiler=None):
+        """
+        :param list tree_files: paths to tree files
+        :param session: database-session
+        :param int n_proc: number of worker processes
+        :param profiler: `phylabelle.profiling.Profiler`
+        """
+        self.tree_files = tree_files
+        self.n_proc = n_proc
+        self.profiler = profiler or NullProfiler()
+
+        with self.profiler.phase('load_assemblies') as phase:
+            self.species_index = Assembly.get_species_index(session)
+            self.assemblies = {asm.accession: asm for asm in Assembly.iter_records(session)}
+            phase.count(assemblies=len(self.assemblies))
+
+    def run(self, threshold, mode='all', matching=False):
+        """
+        evaluate all trees
+        :param float threshold: maximum distance of pairs
+        :param str mode: 'all', 'inter' or 'intra'
+        :param bool matching: aggregate minimum matchings instead of all pairs
+        :return PairSupport:
+        """
+        _shared.update({
+            'species_index': self.species_index,
+            'assemblies': self.assemblies,
+            'threshold': threshold,
+            'mode': mode,
+            'matching': matching,
+        })
+
+        support = PairSupport()
+
+        with self.profiler.phase('evaluate') as phase:
+            pool = multiprocessing.Pool(processes=self.n_proc)
+            try:
+                for tree_file, pairs, error in pool.imap(_evaluate_tree,
+                                                         self.tree_files):
+                    if error is not None:
+                        warnings.warn('Skipping tree {}: {}'.format(tree_file, error))
+                        continue
+                    support.add_tree(pairs)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+                _shared.clear()
+
+            phase.count(trees=support.n_trees, pairs=len(support))
+
+        return support
+
+    def format_results(self, support):
+        """
+        replace accessions by Assembly objects
+        :param PairSupport support:
+        :return list: tuples (assembly1, assembly2, support, mean distance, variance)
+        """
+        return [(self.assemblies[acc1], self.assemblies[acc2], sup, mean, var)
+                for acc1, acc2, sup, mean, var in support]
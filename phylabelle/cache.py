@@ -0,0 +1,145 @@
+# coding: utf-8
+"""
+phylabelle.cache
+================
+
+Persistent cache for evaluated pairs. Entries live in the project database
+and are keyed by the content of the tree file, the labels and species of the
+tree's leaves, the mode and the threshold. A request with a threshold lower
+than or equal to a cached one is answered by filtering the cached pairs.
+
+Since keys are content hashes, entries become unreachable as soon as the tree
+or the labels change. Such stale entries are removed, when a new entry for the
+same tree file is stored.
+"""
+
+import hashlib
+
+from sqlalchemy import and_, or_
+
+from phylabelle.orm import pair_caches, cached_pairs
+
+#: number of rows per executemany call
+BATCH_SIZE = 10000
+
+#: part of every label hash; increase it whenever the pairs found for the same
+#: tree and labels change, so that entries of older versions aren't used
+#: 2: node lists are merged in order of their shifted distances (pairs within
+#: the threshold were lost before)
+CACHE_VERSION = 2
+
+
+def file_hash(filename):
+    """
+    :param str filename:
+    :return str: sha1 hex digest of the file content
+    """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def label_hash(leaves, assemblies):
+    """
+    :param iterable leaves: leaf names (assembly accessions)
+    :param dict assemblies: assemblies keyed by accession
+    :return str: sha1 hex digest of label and species of every leaf
+    """
+    sha = hashlib.sha1()
+    sha.update('v{}\n'.format(CACHE_VERSION))
+    for name in sorted(leaves):
+        try:
+            asm = assemblies[name]
+        except KeyError:
+            continue
+        sha.update('{}\t{}\t{}\n'.format(name, asm.label, asm.species_tax_id))
+    return sha.hexdigest()
+
+
+class PairCache(object):
+    """
+    Stores and retrieves pairs of a PhyloTree evaluation.
+    """
+    def __init__(self, session):
+        """
+        :param session: database-session. The cache uses the session's engine
+                        with connections of its own, so committing an entry
+                        doesn't expire the objects loaded by the session.
+        """
+        self.engine = session.get_bind()
+        # projects created before the cache was introduced lack the tables
+        pair_caches.create(self.engine, checkfirst=True)
+        cached_pairs.create(self.engine, checkfirst=True)
+
+    def lookup(self, tree_hash, label_hash_, mode, threshold):
+        """
+        :param str tree_hash:
+        :param str label_hash_:
+        :param str mode:
+        :param float threshold:
+        :return list: tuples (accession1, accession2, distance) with
+                      distance <= threshold, or None if nothing is cached
+        """
+        entry = self.engine.execute(
+            pair_caches.select().where(and_(
+                pair_caches.c.tree_hash == tree_hash,
+                pair_caches.c.label_hash == label_hash_,
+                pair_caches.c.mode == mode,
+                pair_caches.c.threshold >= threshold,
+            )).order_by(pair_caches.c.threshold).limit(1)
+        ).first()
+
+        if entry is None:
+            return None
+
+        rows = self.engine.execute(
+            cached_pairs.select().where(and_(
+                cached_pairs.c._cache_id == entry.id,
+                cached_pairs.c.distance <= threshold,
+            )))
+
+        return [(row.accession1, row.accession2, row.distance) for row in rows]
+
+    def store(self, tree_path, tree_hash, label_hash_, mode, threshold, pairs):
+        """
+        store pairs. Entries of the same tree file with different content or
+        labels, and entries with the same key and a lower threshold are removed.
+        :param str tree_path:
+        :param str tree_hash:
+        :param str label_hash_:
+        :param str mode:
+        :param float threshold:
+        :param iterable pairs: tuples (accession1, accession2, distance)
+        """
+        stale = or_(
+            and_(pair_caches.c.tree_path == tree_path,
+                 or_(pair_caches.c.tree_hash != tree_hash,
+                     pair_caches.c.label_hash != label_hash_)),
+            and_(pair_caches.c.tree_hash == tree_hash,
+                 pair_caches.c.label_hash == label_hash_,
+                 pair_caches.c.mode == mode,
+                 pair_caches.c.threshold <= threshold),
+        )
+        with self.engine.begin() as conn:
+            stale_ids = [row.id for row in conn.execute(pair_caches.select().where(stale))]
+            if stale_ids:
+                conn.execute(cached_pairs.delete().where(
+                    cached_pairs.c._cache_id.in_(stale_ids)))
+                conn.execute(pair_caches.delete().where(
+                    pair_caches.c.id.in_(stale_ids)))
+
+            cache_id = conn.execute(pair_caches.insert().values(
+                tree_path=tree_path, tree_hash=tree_hash, label_hash=label_hash_,
+                mode=mode, threshold=threshold)).inserted_primary_key[0]
+
+            rows = []
+            for acc1, acc2, dist in pairs:
+                rows.append({'_cache_id': cache_id, 'accession1': acc1,
+                             'accession2': acc2, 'distance': dist})
+                if len(rows) >= BATCH_SIZE:
+                    conn.execute(cached_pairs.insert(), rows)
+                    rows = []
+            if rows:
+                conn.execute(cached_pairs.insert(), rows)
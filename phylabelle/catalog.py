@@ -0,0 +1,378 @@
+# coding: utf-8
+"""
+phylabelle.catalog
+==================
+
+Indexed local copy of the NCBI assembly summaries. Each summary file is
+imported into the project database once, together with the unified species
+and strain names used for mapping. As long as size and modification time of
+the file (and settings.NAME_ILLEGALS and ASSEMBLY_LEVELS) are unchanged, the
+import is skipped.
+If a file has changed, only rows of new, changed or removed accessions are
+written, and the positions of the other rows are updated
+(see Catalog.import_summary).
+
+`selection.PreProcessor` and `selection.MappingProcessor` read from the
+catalog instead of the files, if one is given. Lookups by accession,
+bioproject and name are then indexed joins against temporary tables, and
+return the same rows, in the same order, as a scan of the file: rows are
+ordered by their position in the file, which matters for assemblies of
+equal score.
+"""
+
+import hashlib
+import multiprocessing
+import os
+from collections import defaultdict, deque
+
+from sqlalchemy import Column, String, Integer, and_, select, union, literal_column, func
+
+from phylabelle.fileio import iter_column_chunks, get_byte_ranges
+from phylabelle.orm import catalog, catalog_sources, temporary_table, accession_table, \
+    insert_rows, iter_rows
+from phylabelle.selection import SUMMARY_COLUMNS, METADATA_FIELDS, NAME_CACHE_SIZE, \
+    SHARD_SIZE, AssemblyMetadata, AssemblyScorer, NameCache
+
+#: number of rows per executemany call
+BATCH_SIZE = 10000
+
+#: data shared with forked worker processes, set by Catalog._iter_shards
+_shared = {}
+
+
+def _parse_catalog_shard(task):
+    """
+    parse a range of a summary file for the catalog; runs inside a worker process
+    :param tuple task: (filename, byte_range)
+    :return tuple: list of parsed rows (see Catalog._parse_shard) and
+                   (hits, misses) of the name cache
+    """
+    filename, byte_range = task
+    catalog_ = _shared['catalog']
+    hits, misses = catalog_.names.stats()
+    parsed = catalog_._parse_shard(filename, byte_range, _shared['known'])
+    new_hits, new_misses = catalog_.names.stats()
+    return parsed, (new_hits - hits, new_misses - misses)
+
+
+def _text(value):
+    """
+    sqlite refuses non-ascii bytestrings; summary files are utf-8 encoded.
+    Accessions and other identifiers are ascii and stored as they are.
+    """
+    return value.decode('utf-8', 'replace')
+
+
+def _bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class Catalog(object):
+    """
+    Imports assembly summaries and answers the queries of the mapping
+    process.
+    """
+    def __init__(self, session, settings, n_proc=1):
+        """
+        :param session: database-session. The catalog uses the session's engine
+                        with connections of its own.
+        :param module settings:
+        :param int n_proc: number of processes parsing summary files on import
+        """
+        self.n_proc = n_proc
+        self.engine = session.get_bind()
+        # projects created before the catalog was introduced lack the tables;
+        # outdated ones are replaced by orm.upgrade_schema
+        catalog.create(self.engine, checkfirst=True)
+        catalog_sources.create(self.engine, checkfirst=True)
+
+        self.name_illegals = settings.NAME_ILLEGALS
+        self.assembly_levels = settings.ASSEMBLY_LEVELS
+        self.names = NameCache(settings.NAME_ILLEGALS,
+                               getattr(settings, 'NAME_CACHE_SIZE', NAME_CACHE_SIZE))
+        self.scorer = AssemblyScorer(settings.ASSEMBLY_LEVELS)
+
+    def fingerprint(self, filename):
+        """
+        :param str filename: summary file
+        :return dict: source, size, mtime of the file, name_illegals and
+                      assembly_levels
+        """
+        stat = os.stat(filename)
+        return {
+            'source': os.path.basename(filename),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'name_illegals': ','.join(self.name_illegals),
+            'assembly_levels': ','.join(self.assembly_levels),
+        }
+
+    def is_current(self, filename):
+        """
+        :param str filename: summary file
+        :return bool: True, if the file is imported and unchanged since
+        """
+        fingerprint = self.fingerprint(filename)
+        row = self.engine.execute(catalog_sources.select().where(
+            catalog_sources.c.source == fingerprint['source'])).first()
+
+        if row is None:
+            return False
+        return all(row[key] == value for key, value in fingerprint.iteritems())
+
+    def update(self, filenames, force=False):
+        """
+        import the summary files, that have changed since their last import
+        :param list filenames: summary files
+        :param bool force: import all files
+        :return list: imported files
+        """
+        imported = []
+        for filename in filenames:
+            if force or not self.is_current(filename):
+                self.import_summary(filename)
+                imported.append(filename)
+        return imported
+
+    def import_summary(self, filename):
+        """
+        bring the rows of a summary file in the catalog up to date. If the file
+        has been imported before, only rows that are new or have changed are
+        inserted, and rows that have changed or are gone are deleted. Rows that
+        are kept get their new position in the file (column line).
+        :param str filename: summary file
+        :return tuple: number of inserted and of deleted rows
+        """
+        fingerprint = self.fingerprint(filename)
+        source = fingerprint['source']
+        self.names.reset_stats()
+
+        with self.engine.begin() as conn:
+            previous = conn.execute(catalog_sources.select().where(
+                catalog_sources.c.source == source)).first()
+
+            # (accession, row_hash) -> (id, line) of rows in the catalog
+            known = defaultdict(list)
+            if previous is not None and \
+                    previous['name_illegals'] == fingerprint['name_illegals'] and \
+                    previous['assembly_levels'] == fingerprint['assembly_levels']:
+                query = select([catalog.c.accession, catalog.c.row_hash, catalog.c.id,
+                                catalog.c.line]).where(catalog.c.source == source)
+                for acc, row_hash, id_, line in iter_rows(conn.execute(query)):
+                    known[(acc, row_hash)].append((id_, line))
+            else:
+                conn.execute(catalog.delete().where(catalog.c.source == source))
+
+            moved = []
+            inserted = insert_rows(conn, catalog, self._iter_rows(filename, source, known, moved),
+                                   batch_size=BATCH_SIZE, prefix='')
+
+            # rows of the catalog which haven't been found in the file
+            with temporary_table(conn, 'tmp_ids', Column('id', Integer, primary_key=True)) as tmp:
+                deleted = insert_rows(conn, tmp, ({'id': id_} for rows in known.itervalues()
+                                                  for id_, line in rows))
+                conn.execute(catalog.delete().where(catalog.c.id.in_(select([tmp.c.id]))))
+
+            # rows, that are unchanged, but at another position in the file
+            with temporary_table(conn, 'tmp_lines', Column('id', Integer, primary_key=True),
+                                 Column('line', Integer)) as tmp:
+                insert_rows(conn, tmp, ({'id': id_, 'line': line} for id_, line in moved))
+                conn.execute(catalog.update().where(
+                    catalog.c.id.in_(select([tmp.c.id]))).values(
+                    line=select([tmp.c.line]).where(tmp.c.id == catalog.c.id).as_scalar()))
+
+            fingerprint['rows'] = conn.execute(select([func.count()]).where(
+                catalog.c.source == source)).scalar()
+            conn.execute(catalog_sources.delete().where(catalog_sources.c.source == source))
+            conn.execute(catalog_sources.insert(), fingerprint)
+
+        self.names.log_stats()
+        if inserted or deleted:
+            self.engine.execute('ANALYZE catalog')
+
+        return inserted, deleted
+
+    def _iter_rows(self, filename, source, known, moved):
+        """
+        rows of a summary file, that are not in known
+        :param dict known: (accession, row_hash) -> list of (id, line). Rows
+                           found in the file are removed.
+        :param list moved: (id, line) of the rows found in known, whose line
+                           has changed, are appended
+        """
+        line = 0
+        for parsed in self._iter_shards(filename, known):
+            for row, row_hash, values in parsed:
+                line += 1
+                ids = known.get((row[0], row_hash))
+                if ids:
+                    id_, old_line = ids.pop()
+                    if old_line != line:
+                        moved.append((id_, line))
+                    continue
+
+                if values is None:
+                    # a repeated row, of which fewer copies are known
+                    values = self._parse_row(row, row_hash)
+                values['source'] = source
+                values['line'] = line
+                yield values
+
+    def _iter_shards(self, filename, known):
+        """
+        parse a summary file in ranges of bytes. If n_proc > 1, ranges are
+        parsed concurrently in a pool of worker processes; at most n_proc
+        parsed ranges wait to be written.
+        :param dict known: see _iter_rows; rows in known are not parsed
+        :return: iterator over lists of parsed rows (see _parse_shard), in
+                 the order of the file
+        """
+        shards = get_byte_ranges(filename, max(self.n_proc,
+                                               os.path.getsize(filename) // SHARD_SIZE + 1))
+
+        if self.n_proc <= 1:
+            for byte_range in shards:
+                yield self._parse_shard(filename, byte_range, known)
+            return
+
+        # workers are forked and inherit the catalog and the known rows
+        _shared.update({'catalog': self, 'known': known})
+        pool = multiprocessing.Pool(processes=self.n_proc)
+        try:
+            pending = deque()
+            for byte_range in shards:
+                pending.append(pool.apply_async(_parse_catalog_shard, ((filename, byte_range),)))
+                if len(pending) > self.n_proc:
+                    yield self._collect_shard(pending.popleft())
+            while pending:
+                yield self._collect_shard(pending.popleft())
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _shared.clear()
+
+    def _collect_shard(self, result):
+        """
+        :param AsyncResult result: of _parse_catalog_shard
+        :return list: parsed rows; the worker's name cache lookups are added
+                      to self.names
+        """
+        parsed, stats = result.get()
+        self.names.add_stats(*stats)
+        return parsed
+
+    def _parse_shard(self, filename, byte_range, known):
+        """
+        :param tuple byte_range: see fileio.get_byte_ranges
+        :param dict known: see _iter_rows
+        :return list: tuples (row, row_hash, values); values is a dict of
+                      catalog columns, or None if the row is in known
+        """
+        parsed = []
+        for rows in iter_column_chunks(filename, SUMMARY_COLUMNS, comment_prefix='#', skip=1,
+                                       byte_range=byte_range):
+            for row in rows:
+                row_hash = hashlib.md5('\t'.join(row)).hexdigest()[:16]
+                if (row[0], row_hash) in known:
+                    parsed.append((row, row_hash, None))
+                else:
+                    parsed.append((row, row_hash, self._parse_row(row, row_hash)))
+        return parsed
+
+    def _parse_row(self, row, row_hash):
+        """
+        :param tuple row: values of SUMMARY_COLUMNS
+        :return dict: catalog columns, except source and line
+        """
+        acc, bioproj, plain_spec, plain_strain, rs_ref, version_status, asm_level, \
+            ftp_source, rel_date, asm_name, tax_id, species_tax_id = row
+        spec, strain = self.names.unify(plain_spec, plain_strain)
+        version_status = version_status.strip()
+        date, ordinal, version_bonus, level_bonus = self.scorer.get_components(
+            rel_date, version_status, asm_level)
+        return {
+            'accession': acc,
+            'row_hash': row_hash,
+            'bioproject': bioproj,
+            'species_key': _text(spec),
+            'strain_key': _text(strain),
+            'gbrs_paired_asm': rs_ref,
+            'version_status': version_status,
+            'assembly_level': asm_level,
+            'submission_date': date,
+            'release_ordinal': ordinal,
+            'version_bonus': version_bonus,
+            'level_bonus': level_bonus,
+            'score': ordinal + version_bonus + level_bonus + self.scorer.refseq,
+            'ftp_source': ftp_source,
+            'assembly_name': _text(asm_name),
+            'tax_id': tax_id,
+            'species_tax_id': species_tax_id,
+            'organism_name': _text(plain_spec),
+            'infraspecific_name': _text(plain_strain),
+        }
+
+    def read_summary(self, filename, accessions=None, candidates=None):
+        """
+        Same as `selection.PreProcessor.read_summary`, for an imported summary file.
+        :param str filename: summary file
+        :param set accessions: if given, skip rows of other accessions
+        :param tuple candidates: (bioprojects, names, species) if given, keep
+                                 only rows whose bioproject is in bioprojects,
+                                 whose (species, strain) is in names or whose
+                                 species is in species
+        :return list: tuples, as returned by PreProcessor._read_row
+        """
+        query = select([catalog]).where(catalog.c.source == os.path.basename(filename))
+
+        with self.engine.connect() as conn:
+            if accessions is None:
+                return self._read_candidates(conn, query, candidates)
+
+            with accession_table(conn, accessions) as tmp:
+                query = query.where(catalog.c.accession.in_(select([tmp.c.accession])))
+                return self._read_candidates(conn, query, candidates)
+
+    def _read_candidates(self, conn, query, candidates):
+        if candidates is None:
+            return self._read(conn, query.order_by(catalog.c.line))
+
+        bioprojects, names, species = candidates
+        with temporary_table(conn, 'tmp_bioprojects',
+                             Column('bioproject', String(20), primary_key=True)) as bp_tmp, \
+                temporary_table(conn, 'tmp_names',
+                                Column('species', String(100), primary_key=True),
+                                Column('strain', String(100), primary_key=True)) as name_tmp, \
+                temporary_table(conn, 'tmp_species',
+                                Column('species', String(100), primary_key=True)) as spec_tmp:
+            insert_rows(conn, bp_tmp, ({'bioproject': bioproj} for bioproj in bioprojects))
+            insert_rows(conn, name_tmp, ({'species': _text(spec), 'strain': _text(strain)}
+                                         for spec, strain in names))
+            insert_rows(conn, spec_tmp, ({'species': _text(spec)} for spec in species))
+
+            by_bioproject = query.select_from(catalog.join(
+                bp_tmp, bp_tmp.c.bioproject == catalog.c.bioproject))
+            by_name = query.select_from(catalog.join(
+                name_tmp, and_(name_tmp.c.species == catalog.c.species_key,
+                               name_tmp.c.strain == catalog.c.strain_key)))
+            by_species = query.select_from(catalog.join(
+                spec_tmp, spec_tmp.c.species == catalog.c.species_key))
+
+            return self._read(conn, union(by_bioproject, by_name, by_species).order_by(
+                literal_column('line')))
+
+    def _read(self, conn, query):
+        results = []
+        for row in iter_rows(conn.execute(query)):
+            row = dict((key, _bytes(value)) for key, value in row.items())
+
+            metadata = AssemblyMetadata(*[row[field] for field in METADATA_FIELDS])
+            results.append((row['bioproject'], row['species_key'], row['strain_key'],
+                            row['accession'], row['score'], row['gbrs_paired_asm'], metadata))
+
+        return results
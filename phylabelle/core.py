@@ -1,16 +1,23 @@
 #!/usr/bin/env python
 # coding: utf-8
+import os
 import warnings
-from collections import deque
+from collections import deque, OrderedDict
 from functools import partial
+from heapq import heappush, heappop, heapreplace, nsmallest
+from itertools import count
+from operator import itemgetter
 
 from networkx import Graph
-from networkx.algorithms.components.connected import connected_component_subgraphs
+from networkx.algorithms.components.connected import connected_component_subgraphs, \
+    number_connected_components
 from networkx.algorithms.matching import max_weight_matching
 from sortedcontainers import SortedListWithKey
 
+from phylabelle.cache import file_hash, label_hash
 from phylabelle.fileio import read_tree
 from phylabelle.orm import Assembly
+from phylabelle.profiling import NullProfiler
 
 # need this sorted list for PhyloTree.evaluate
 # this is meant to store tuples of (distance, node)
@@ -30,26 +37,17 @@ def merge_lists(lists, threshold, dist_shift):
     :return: merged sorted node lists
     :rtype: SortedNodeList
     """
-    try:
-        i, l_ = lists.popleft()
-    except IndexError:
-        return SortedNodeList([])
-
+    # distances are shifted in place, which SortedNodeList doesn't notice;
+    # the merged list is therefore built anew from the shifted values, so it
+    # is sorted by the current distances
+    merged = []
     for i, list_ in lists:
-        l_.update(list_)
-
-    delete = False
-
-    for i, val in enumerate(l_):
-        val[0] += dist_shift
-        if val[0] > threshold:
-            delete = True
-            break
+        for val in list_:
+            val[0] += dist_shift
+            if val[0] <= threshold:
+                merged.append(val)
 
-    if delete:
-        del l_[i:]
-
-    return l_
+    return SortedNodeList(merged)
 
 
 def mean(ls):
@@ -310,22 +308,52 @@ class PhyloTree(object):
         :param session: database-session
         :param float threshold:   a numerical value indicating below which
                                   distance a pair should be considered as such
+        :param profiler: `phylabelle.profiling.Profiler` recording the phases
+                         of loading and evaluation
+        :param dict species_index: preloaded species index (see
+                                   `Assembly.get_species_index`)
+        :param dict assemblies: preloaded assemblies, keyed by accession. If
+                                both species_index and assemblies are given,
+                                session is not used and may be None.
+        :param cache: `phylabelle.cache.PairCache`; if given, evaluate_all_pairs
+                      reuses and stores its results there
         """
         assert type(tree) == str
 
-        self.root = read_tree(tree)
+        self.tree_file = tree
+        self.session = session
+        self.profiler = kwargs.get('profiler') or NullProfiler()
+        self.cache = kwargs.get('cache')
+
+        with self.profiler.phase('read_tree') as phase:
+            self.root = read_tree(tree)
+            phase.count(leaves=len(self.root))
 
         assert len(self.root.children) == 2, 'Trying to work with unrooted Tree'
 
-        self.species_index = Assembly.get_species_index(session)
+        self._rename_leaves()
+        self.leaf_index = {leaf.name: leaf for leaf in self.root.iter_leaves()}
+
+        if kwargs.get('species_index') is not None:
+            self.species_index = kwargs['species_index']
+        else:
+            with self.profiler.phase('get_species_index') as phase:
+                self.species_index = Assembly.get_species_index(session,
+                                                                subset=self.leaf_index)
+                phase.count(assemblies=len(self.species_index))
 
         global same_species
         same_species = partial(same_species_plain, species=self.species_index)
 
-        self._rename_leaves()
-        self.assemblies = self.load_assemblies(session=session)
+        if kwargs.get('assemblies') is not None:
+            self.assemblies = kwargs['assemblies']
+        else:
+            with self.profiler.phase('load_assemblies') as phase:
+                self.assemblies = self.load_assemblies(session=session)
+                phase.count(assemblies=len(self.assemblies))
         self.labels = {k: v.label for k, v in self.assemblies.iteritems()}
         self._assign_labels()
+        self._label_bounds = None
         if 'threshold' in kwargs:
             self.results = PairGraph(max_dist=kwargs['threshold'])
         else:
@@ -344,6 +372,31 @@ class PhyloTree(object):
             except KeyError:
                 pass
 
+    def _assign_label_bits(self, labellings):
+        """
+        Assign several labellings at once. Every leaf gets two bit vectors
+        (as int): label_bits holds the labels, known_bits indicates for which
+        labellings the leaf has a label at all. Bit i refers to the i-th
+        labelling. A label None counts as negative, like in evaluate.
+        :param list labellings: list of dicts {accession: label}
+        """
+        for leaf in self.root.iter_leaves():
+            leaf.label_bits = 0
+            leaf.known_bits = 0
+
+            if leaf.name not in self.assemblies:
+                continue
+
+            for i, labels in enumerate(labellings):
+                try:
+                    label = labels[leaf.name]
+                except KeyError:
+                    continue
+
+                leaf.known_bits |= 1 << i
+                if label:
+                    leaf.label_bits |= 1 << i
+
     def _format_results(self, results):
         """
         provide output as sorted list of tuples (node1, node2, distance)
@@ -355,9 +408,11 @@ class PhyloTree(object):
                                  key=lambda x: x[2])
 
     def load_assemblies(self, session):
-        leaves = [x.name for x in self.root.iter_leaves()]
-        asm_index = {x.accession: x for x in Assembly.iter_all(session, subset=leaves)}
-        return asm_index
+        """
+        load the assemblies of all leaves as AssemblyRecords
+        :return dict: accession -> AssemblyRecord
+        """
+        return {x.accession: x for x in Assembly.iter_records(session, subset=self.leaf_index)}
 
     def get_closest(self):
         """
@@ -367,21 +422,333 @@ class PhyloTree(object):
         if not len(self.results.edge) > 0:
             raise NoResultsException()
 
-        return self._format_results(self.results.get_closest())
+        with self.profiler.phase('closest') as phase:
+            results = self._format_results(self.results.get_closest())
+            phase.count(pairs=len(results))
+
+        return results
+
+    def get_closest_accessions(self):
+        """
+        like get_closest, but without loading assemblies
+        :return list results: [(accession1, accession2, distance), ...], sorted by distance
+        """
+        if not len(self.results.edge) > 0:
+            raise NoResultsException()
+
+        with self.profiler.phase('closest') as phase:
+            results = sorted(self.results.get_closest(), key=itemgetter(2))
+            phase.count(pairs=len(results))
+
+        return results
+
+    def get_minimum_matching_accessions(self):
+        """
+        like get_minimum_matching, but without loading assemblies
+        :return list results: [(accession1, accession2, distance), ...], sorted by distance
+        """
+        with self.profiler.phase('matching') as phase:
+            results = sorted(self.results.get_minimum_matching(), key=itemgetter(2))
+            if self.profiler.enabled:
+                phase.count(pairs=len(results),
+                            components=number_connected_components(self.results))
+
+        return results
 
     def get_minimum_matching(self):
-        return self._format_results(self.results.get_minimum_matching())
+        with self.profiler.phase('matching') as phase:
+            results = self._format_results(self.results.get_minimum_matching())
+            if self.profiler.enabled:
+                phase.count(pairs=len(results),
+                            components=number_connected_components(self.results))
+
+        return results
 
     def _rename_leaves(self):
         for leaf in self.root.iter_leaves():
             leaf.name = '_'.join(leaf.name.split('_')[:2])
 
+    def _cache_key(self):
+        """
+        :return tuple: hashes of the tree file and of the leaves' labels,
+                       see phylabelle.cache
+        """
+        tree_hash = file_hash(self.tree_file)
+        labels = label_hash((leaf.name for leaf in self.root.iter_leaves()),
+                            self.assemblies)
+        return tree_hash, labels
+
+    def _lookup_cache(self, tree_hash, labels, mode, distance):
+        """
+        :return list: cached pairs (see PairCache.lookup), or None
+        """
+        with self.profiler.phase('cache_lookup') as phase:
+            pairs = self.cache.lookup(tree_hash, labels, mode, distance)
+            phase.count(pairs=len(pairs) if pairs is not None else 0)
+        return pairs
+
     def evaluate_all_pairs(self, distance,
                            mode='all'):
 
+        if self.cache is not None:
+            tree_hash, labels = self._cache_key()
+            pairs = self._lookup_cache(tree_hash, labels, mode, distance)
+
+            if pairs is not None:
+                self.set_results(pairs, distance, mode=mode)
+                return
+
         # self.pair_graph = PairGraph()
         self.results = PairGraph(mode=mode, max_dist=distance)
-        self.evaluate(self.root, distance)
+        with self.profiler.phase('evaluate') as phase:
+            self.evaluate(self.root, distance)
+            phase.count(leaves=len(self.root), pairs=self.results.number_of_edges(),
+                        nodes=self.results.number_of_nodes())
+
+        if self.cache is not None:
+            with self.profiler.phase('cache_store'):
+                self.cache.store(os.path.abspath(self.tree_file), tree_hash, labels,
+                                 mode, distance, self.results.get_closest())
+
+    def set_results(self, pairs, distance, mode='all'):
+        """
+        replace results by already evaluated pairs
+        :param iterable pairs: tuples (accession1, accession2, distance)
+        :param float distance: threshold the pairs were evaluated with
+        :param str mode: mode the pairs were evaluated with
+        """
+        self.results = PairGraph(mode=mode, max_dist=distance)
+        for acc1, acc2, dist in pairs:
+            self.results.add_edge(acc1, acc2, distance=dist)
+
+    def _get_label_bounds(self):
+        """
+        Distance bounds used by evaluate_top_pairs, computed once per tree.
+        For every node a tuple *(pos, neg, own, clade)*: the distance from the
+        node to the closest positive and the closest negative leaf below it,
+        the minimum distance of a pair joined at the node, and the minimum
+        distance of a pair anywhere in the node's clade.
+        :return dict: node -> tuple of bounds
+        """
+        if self._label_bounds is not None:
+            return self._label_bounds
+
+        inf = float('inf')
+        bounds = {}
+
+        for node in self.root.traverse('postorder'):
+            if node.is_leaf():
+                try:
+                    label = node.label
+                except AttributeError:
+                    bounds[node] = (inf, inf, inf, inf)
+                    continue
+                if label:
+                    bounds[node] = (0., inf, inf, inf)
+                else:
+                    bounds[node] = (inf, 0., inf, inf)
+                continue
+
+            up = [(bounds[child][0] + child.dist, bounds[child][1] + child.dist)
+                  for child in node.children]
+
+            own = inf
+            for i, (pos, _) in enumerate(up):
+                for j, (_, neg) in enumerate(up):
+                    if i != j and pos + neg < own:
+                        own = pos + neg
+
+            bounds[node] = (min(pos for pos, _ in up), min(neg for _, neg in up), own,
+                            min([own] + [bounds[child][3] for child in node.children]))
+
+        self._label_bounds = bounds
+        return bounds
+
+    def evaluate_top_pairs(self, k, distance=float('inf'), mode='all'):
+        """
+        find the k pairs with the smallest distances, without evaluating all
+        pairs below distance. Clades are visited in order of the smallest
+        distance a pair inside them can have; the distance of the k-th best
+        pair found so far serves as threshold for the remaining traversal, so
+        the search stops as soon as no clade can contain a closer pair.
+        Results are stored in self.results, like in evaluate_all_pairs.
+        If all pairs within distance are cached (see evaluate_all_pairs), the
+        k closest of them are taken instead.
+        :param int k: number of pairs
+        :param float distance: threshold
+        :param str mode: 'all', 'inter' or 'intra'
+        """
+        if self.cache is not None:
+            pairs = self._lookup_cache(*self._cache_key() + (mode, distance))
+            if pairs is not None:
+                self.set_results(nsmallest(k, pairs, key=itemgetter(2)), distance, mode=mode)
+                return
+
+        self.results = PairGraph(mode=mode, max_dist=distance)
+        bounds = self._get_label_bounds()
+        inf = float('inf')
+
+        if mode == 'inter':
+            accept = lambda leaf1, leaf2: not same_species(leaf1.name, leaf2.name)
+        elif mode == 'intra':
+            accept = lambda leaf1, leaf2: same_species(leaf1.name, leaf2.name)
+        else:
+            accept = None
+
+        #: bounded max-heap of (-distance, positive leaf name, negative leaf name)
+        best = []
+
+        def limit():
+            if len(best) < k:
+                return distance
+            return min(distance, -best[0][0])
+
+        def collect(child, label_index, max_dist):
+            # leaves with the given label below child, no farther than
+            # max_dist from child's parent
+            leaves = []
+            stack = [(child, child.dist)]
+            while stack:
+                node, dist = stack.pop()
+                bound = bounds[node][label_index]
+                if bound == inf or dist + bound > max_dist:
+                    continue
+                if node.is_leaf():
+                    leaves.append((dist, node))
+                else:
+                    stack.extend((c, dist + c.dist) for c in node.children)
+            leaves.sort(key=itemgetter(0))
+            return leaves
+
+        tie = count()
+        queue = [(bounds[self.root][3], next(tie), True, self.root)]
+        n_nodes = 0
+
+        with self.profiler.phase('evaluate') as phase:
+            while queue and k > 0:
+                bound, _, is_clade, node = heappop(queue)
+                if bound > limit() or (len(best) == k and bound >= limit()):
+                    break
+
+                if is_clade:
+                    heappush(queue, (bounds[node][2], next(tie), False, node))
+                    for child in node.children:
+                        if not child.is_leaf():
+                            heappush(queue, (bounds[child][3], next(tie), True, child))
+                    continue
+
+                if len(node.children) < 2:
+                    # no pairs are joined at a unary node
+                    continue
+
+                # evaluate pairs joined at node
+                n_nodes += 1
+                up = [(bounds[child][0] + child.dist, bounds[child][1] + child.dist)
+                      for child in node.children]
+                current = limit()
+                positives = []
+                negatives = []
+                for i, child in enumerate(node.children):
+                    min_neg = min(neg for j, (_, neg) in enumerate(up) if j != i)
+                    min_pos = min(pos for j, (pos, _) in enumerate(up) if j != i)
+                    positives.append(collect(child, 0, current - min_neg))
+                    negatives.append(collect(child, 1, current - min_pos))
+
+                for i, pos_leaves in enumerate(positives):
+                    for j, neg_leaves in enumerate(negatives):
+                        if i == j or not neg_leaves:
+                            continue
+                        for pos_dist, pos_leaf in pos_leaves:
+                            if pos_dist + neg_leaves[0][0] > limit():
+                                break
+                            for neg_dist, neg_leaf in neg_leaves:
+                                d = pos_dist + neg_dist
+                                if d > limit():
+                                    break
+                                if accept is not None and not accept(pos_leaf, neg_leaf):
+                                    continue
+                                if len(best) < k:
+                                    heappush(best, (-d, pos_leaf.name, neg_leaf.name))
+                                elif d < -best[0][0]:
+                                    heapreplace(best, (-d, pos_leaf.name, neg_leaf.name))
+
+            for d, pos_name, neg_name in best:
+                self.results.add_edge(neg_name, pos_name, distance=-d)
+
+            phase.count(leaves=len(self.root), evaluated_nodes=n_nodes,
+                        pairs=self.results.number_of_edges())
+
+    def evaluate_labellings(self, distance, labellings, mode='all'):
+        """
+        find pairs for several labellings in one traversal of the tree.
+        :param float distance: threshold
+        :param OrderedDict labellings: labelling name -> {accession: label}
+        :param str mode: 'all', 'inter' or 'intra'
+        :return OrderedDict: labelling name -> PairGraph
+        """
+        self._assign_label_bits(labellings.values())
+        graphs = [PairGraph(mode=mode, max_dist=distance) for _ in labellings]
+
+        with self.profiler.phase('evaluate') as phase:
+            self._evaluate_label_bits(distance, graphs)
+            phase.count(leaves=len(self.root), labellings=len(graphs),
+                        pairs=sum(g.number_of_edges() for g in graphs))
+
+        self.labelling_results = OrderedDict(zip(labellings.keys(), graphs))
+        return self.labelling_results
+
+    def _evaluate_label_bits(self, threshold, graphs):
+        """
+        Like evaluate, but for label bit vectors (see _assign_label_bits).
+        Instead of separate lists for positive and negative leaves, each node
+        keeps a single list of all labeled leaves within threshold; whether
+        two leaves form a pair is decided per labelling by xor-ing their
+        label bits. Tree is traversed iteratively, so deep trees don't hit
+        the recursion limit.
+        :param float threshold:
+        :param list graphs: one PairGraph per label bit
+        """
+        lists = {}
+
+        for node in self.root.traverse('postorder'):
+            if node.is_leaf():
+                if node.known_bits:
+                    lists[node] = SortedNodeList([[node.dist, node]])
+                else:
+                    lists[node] = SortedNodeList()
+                continue
+
+            children = deque([(i, lists.pop(child)) for i, child in enumerate(node.children)])
+
+            for i, (_, list1) in enumerate(children):
+                for j in xrange(i + 1, len(children)):
+                    list2 = children[j][1]
+                    for dist1, leaf1 in list1:
+                        for dist2, leaf2 in list2:
+                            d = dist1 + dist2
+                            if d > threshold:
+                                break
+                            diff = (leaf1.label_bits ^ leaf2.label_bits) & \
+                                leaf1.known_bits & leaf2.known_bits
+                            bit = 0
+                            while diff:
+                                if diff & 1:
+                                    graphs[bit].add_pair(leaf1.name, leaf2.name, d)
+                                diff >>= 1
+                                bit += 1
+
+            lists[node] = merge_lists(children, threshold, node.dist)
+
+    def get_labelling_results(self, name, matching=False):
+        """
+        :param str name: labelling name, as passed to evaluate_labellings
+        :param bool matching: return minimum matching instead of all pairs
+        :return list results: [(assembly1, assembly2, distance), ...]
+        """
+        graph = self.labelling_results[name]
+        if matching:
+            return self._format_results(graph.get_minimum_matching())
+        return self._format_results(graph.get_closest())
 
     def get_connected_components(self):
         return connected_component_subgraphs(self.results)
@@ -394,6 +761,20 @@ class PhyloTree(object):
         l2 = self.root.get_leaves_by_name(pair.p_acc)[0]
         return self.root.get_distance(l1, l2)
 
+    def get_pair_distance(self, accession1, accession2):
+        """
+        get the distance between two leaves
+        :param str accession1:
+        :param str accession2:
+        :return float: distance, or None if one of the accessions is not in the tree
+        """
+        try:
+            l1 = self.leaf_index[accession1]
+            l2 = self.leaf_index[accession2]
+        except KeyError:
+            return None
+        return self.root.get_distance(l1, l2)
+
     def leaves_unique(self, node=None):
         """
         Sanity check function to check if the leaves are ambiguous or not
@@ -417,6 +798,8 @@ class PhyloTree(object):
         """
         if node is None:
             node = self.root
+            if leaf_name in self.leaf_index:
+                return self.leaf_index[leaf_name]
 
         for leaf in node.iter_leaves():
             if leaf_name in leaf.name:
@@ -426,6 +809,7 @@ class PhyloTree(object):
         # clear buffer
         self.results.clear()
         self.results.max_size = n_results
+        self.results.max_dist = None
         self.results.resize()
         self.results.set_mode(mode)
 
@@ -438,11 +822,13 @@ class PhyloTree(object):
         node = l.up
         evals = {}
 
-        while self.results.number_of_edges() < n_results:
-            evals[node] = self.evaluate(node, inf, evaluated=evals, query=l.name)
-            node = node.up
-            if not node:
-                break
+        with self.profiler.phase('evaluate') as phase:
+            while self.results.number_of_edges() < n_results:
+                evals[node] = self.evaluate(node, inf, evaluated=evals, query=l.name)
+                node = node.up
+                if not node:
+                    break
+            phase.count(evaluated_nodes=len(evals), pairs=self.results.number_of_edges())
 
         return self._format_results(self.results.get_partners(l.name))
 
@@ -5,13 +5,20 @@ phylabelle.fileio
 Input- and output-functions
 """
 
+import datetime
+import gzip
+import json
 import os
 import shutil
 import sys
 import warnings
+from collections import OrderedDict
+from operator import itemgetter
 
 import tabulate
 
+from phylabelle.utils import parse_bool, NoBooleanValueException
+
 
 class AbsolutePathException(Exception):
     """
@@ -231,7 +238,7 @@ class Table(object):
     """
     def __init__(self, filename, access_mode,
                  header=None, seperator='\t',
-                 comment_prefix=None, skip=0):
+                 comment_prefix=None, skip=0, compress=False, buffer_size=-1):
         """
         :param str filename:
         :param access_mode: can be either 'w' or 'r'
@@ -241,6 +248,9 @@ class Table(object):
         prefix that is not part of the first column name itself, this can
         be specified here
         :param int skip: number of lines to be skipped
+        :param bool compress: gzip compressed file
+        :param int buffer_size: size of the file buffer in bytes, -1 for the
+                                system default
         """
         self.filename = filename
         self.access_mode = access_mode
@@ -248,6 +258,8 @@ class Table(object):
         self.comment_prefix = comment_prefix
         self.header = header
         self.skip = skip
+        self.compress = compress
+        self.buffer_size = buffer_size
 
     def __iter__(self):
         assert hasattr(self, 'file'), 'Needs to be entered via with statement'
@@ -256,8 +268,10 @@ class Table(object):
     def __enter__(self):
         if self.filename == 'stdout':
             self.file = sys.stdout
+        elif self.compress:
+            self.file = gzip.open(self.filename, self.access_mode + 'b')
         else:
-            self.file = open(self.filename, self.access_mode)
+            self.file = open(self.filename, self.access_mode, self.buffer_size)
 
         if self.access_mode == 'r' and self.header is None:
             for i in xrange(self.skip):
@@ -298,6 +312,131 @@ class Table(object):
 
         self.file.write(str_)
 
+    def write_lines(self, lines):
+        """
+        write several lines with a single call
+        :param iterable lines: lists of strings or `Line` objects
+        """
+        self.file.write(''.join(self.seperator.join(line) + '\n' for line in lines))
+
+
+#: bytes per read of iter_column_chunks
+CHUNK_SIZE = 1 << 24
+
+
+def iter_column_chunks(filename, columns, seperator='\t', comment_prefix=None, skip=0,
+                       chunk_size=CHUNK_SIZE, keys=None, byte_range=None):
+    """
+    Fast, read-only alternative to `Table` for large files. The file is read
+    in chunks of bytes; every line is split only up to the last requested
+    column, and instead of `Line` objects plain tuples are returned.
+
+    .. code-block:: python
+
+        for rows in iter_column_chunks('summary.txt', ['assembly_accession', 'taxid'],
+                                       comment_prefix='#', skip=1):
+            for acc, tax_id in rows:
+                pass
+
+    :param str filename:
+    :param list columns: names of columns, as found in the header line
+    :param str seperator:
+    :param str comment_prefix: prefix of the header line (see `Header`)
+    :param int skip: number of lines before the header line
+    :param int chunk_size: bytes per read
+    :param set keys: if given, only lines whose first field is in keys are
+                     returned. The first field is compared before the line
+                     is split, so other lines are dropped at little cost.
+    :param tuple byte_range: (start, end) read only lines within this range
+                             of bytes (see `get_byte_ranges`). The header is
+                             read from the start of the file anyway.
+    :return: iterator over lists of tuples; the tuples hold the values of
+             columns in the given order. Lines with too few fields are skipped.
+    """
+    with open(filename, 'rb') as f:
+        for i in xrange(skip):
+            f.readline()
+        header = Header(seperator, line=f.readline(), prefix=comment_prefix)
+
+        indices = [header.get_index(col) for col in columns]
+        max_split = max(indices) + 1
+        if len(indices) == 1:
+            index = indices[0]
+            get = lambda fields: (fields[index],)
+        else:
+            get = itemgetter(*indices)
+
+        if byte_range is None:
+            remaining = None
+        else:
+            start, stop = byte_range
+            start = max(start, f.tell())
+            f.seek(start)
+            remaining = stop - start
+
+        rest = ''
+        while True:
+            if remaining is None:
+                chunk = f.read(chunk_size)
+            elif remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                remaining -= len(chunk)
+            else:
+                break
+
+            if not chunk:
+                break
+
+            chunk = rest + chunk
+            end = chunk.rfind('\n')
+            if end < 0:
+                rest = chunk
+                continue
+
+            rest = chunk[end + 1:]
+            yield _split_rows(chunk[:end].split('\n'), seperator, max_split, get, keys)
+
+        if rest:
+            yield _split_rows(rest.split('\n'), seperator, max_split, get, keys)
+
+
+def get_byte_ranges(filename, parts):
+    """
+    split a file into ranges of bytes, that begin and end at line boundaries
+    :param str filename:
+    :param int parts: (maximum) number of ranges
+    :return list: tuples (start, end)
+    """
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as f:
+        for i in xrange(1, parts):
+            pos = max(size * i / parts, bounds[-1])
+            f.seek(pos)
+            f.readline()
+            pos = f.tell()
+            if pos >= size:
+                break
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    bounds.append(size)
+
+    return zip(bounds[:-1], bounds[1:])
+
+
+def _split_rows(lines, seperator, max_split, get, keys=None):
+    rows = []
+    append = rows.append
+    if keys is not None:
+        lines = [line for line in lines if line[:line.find(seperator)] in keys]
+
+    for line in lines:
+        try:
+            append(get(line.split(seperator, max_split)))
+        except IndexError:
+            continue
+    return rows
+
 
 class BufferedTable(Table):
     """
@@ -351,13 +490,46 @@ class BufferedTable(Table):
                 self.file.write('\n')
 
 
-def fmt_pair(pair):
+def read_labellings(filename, seperator='\t'):
+    """
+    read a table of several labellings. The first column holds assembly
+    accessions, every further column one labelling, named by its header.
+    Empty fields and fields not holding a boolean value (see
+    `phylabelle.utils.parse_bool`) are treated as missing labels.
+
+    :param str filename:
+    :param str seperator:
+    :return OrderedDict: labelling name -> {accession: label}
+    """
+    with Table(filename, 'r', seperator=seperator) as tab:
+        names = tab.header.list_[1:]
+        labellings = OrderedDict((name.strip(), {}) for name in names)
+
+        for line in tab:
+            acc = line.values[0].strip()
+            for name, value in zip(labellings.keys(), line.values[1:]):
+                try:
+                    labellings[name][acc] = parse_bool(value.strip())
+                except NoBooleanValueException:
+                    pass
+
+    return labellings
+
+
+def fmt_pair(pair, labels=None):
     """
     :param pair: tuple of the form (Assembly1, Assembly2, distance)
+    :param dict labels: use these labels ({accession: label}) instead of
+                        the labels stored with the assemblies
     :return:
     """
     asm1, asm2, dist = pair
-    if asm1.label:
+    if labels is not None:
+        label = labels[asm1.accession]
+    else:
+        label = asm1.label
+
+    if label:
         t_asm = asm1
         f_asm = asm2
     else:
@@ -367,11 +539,12 @@ def fmt_pair(pair):
     return [t_asm.accession, t_asm.organism_name, f_asm.accession, f_asm.organism_name, dist]
 
 
-def get_pretty_output(results, sort_by):
+def get_pretty_output(results, sort_by, labels=None):
     """
     takes a list of pairs and prints it in a pretty way
     :param results: iterable of pairs, i.e. tuples of the form *(accession1, accession2, distance)*
     :param str sort_by:
+    :param dict labels: labels deciding which partner is positive (see fmt_pair)
     """
     header = ['Positive Accession', 'Positive Name', 'Negative Accession', 'Negative Name', 'Distance']
 
@@ -385,4 +558,209 @@ def get_pretty_output(results, sort_by):
     else:
         func = lambda line: line[3]
 
-    print tabulate.tabulate(sorted((fmt_pair(x) for x in results), key=func), headers=header)
+    print tabulate.tabulate(sorted((fmt_pair(x, labels) for x in results), key=func),
+                            headers=header)
+
+
+def get_support_output(results, sort_by, n_trees, max_=None):
+    """
+    print pairs aggregated over several trees
+    :param results: iterable of tuples *(assembly1, assembly2, support, mean distance, variance)*
+    :param str sort_by: 'dist', 'support', 'p_name' or 'np_name'
+    :param int n_trees: number of evaluated trees
+    :param int max_: print only the first max_ lines
+    """
+    header = ['Positive Accession', 'Positive Name', 'Negative Accession', 'Negative Name',
+              'Mean Distance', 'Variance', 'Support']
+
+    if sort_by == 'dist':
+        func = lambda line: line[4]
+    elif sort_by == 'support':
+        func = lambda line: (-line[6], line[4])
+    elif sort_by == 'p_name':
+        func = lambda line: line[1]
+    else:
+        func = lambda line: line[3]
+
+    lines = sorted((fmt_pair((asm1, asm2, mean)) + [var, support]
+                    for asm1, asm2, support, mean, var in results), key=func)
+
+    print 'Pairs aggregated over {} trees'.format(n_trees)
+    print tabulate.tabulate(lines[:max_], headers=header)
+
+
+class PairWriter(object):
+    """
+    Base class for streaming pair output. Rows are tuples of the form
+    *(positive accession, negative accession, distance, positive metadata...,
+    negative metadata...)* and are written batch by batch, so that memory
+    consumption doesn't depend on the number of pairs.
+
+    .. code-block:: python
+
+        with TsvPairWriter('pairs.tsv', columns=['organism_name']) as writer:
+            write_pairs(pairs, writer, labels, fetch_metadata)
+    """
+    #: size of the write buffer
+    buffer_size = 1 << 20
+
+    def __init__(self, filename, columns=(), column_types=None):
+        """
+        :param str filename: output file, 'stdout' writes to standard output
+        :param list columns: names of assembly columns, written for both partners
+        :param dict column_types: python type of each column, e.g. {'label': bool}
+        """
+        self.filename = filename
+        self.columns = list(columns)
+        self.column_types = column_types or {}
+        self.fields = ['positive_accession', 'negative_accession', 'distance'] + \
+                      ['positive_{}'.format(col) for col in self.columns] + \
+                      ['negative_{}'.format(col) for col in self.columns]
+
+    def __enter__(self):
+        if self.filename == 'stdout':
+            self.file = sys.stdout
+        else:
+            self.file = open(self.filename, 'w', self.buffer_size)
+        self.write_header()
+        return self
+
+    def __exit__(self, exception_type, exception_val, trace):
+        if self.file is sys.stdout:
+            self.file.flush()
+        else:
+            self.file.close()
+
+    def write_header(self):
+        pass
+
+    def write_batch(self, rows):
+        raise NotImplementedError
+
+
+class TsvPairWriter(PairWriter):
+    """
+    tab-separated values with a header line; missing values are left empty
+    """
+    def write_header(self):
+        self.file.write('\t'.join(self.fields))
+        self.file.write('\n')
+
+    def write_batch(self, rows):
+        self.file.write(''.join('\t'.join(_tsv_value(x) for x in row) + '\n'
+                                for row in rows))
+
+
+def _tsv_value(value):
+    """
+    :return str: value as utf-8 encoded string, empty if value is None
+    """
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class JsonlPairWriter(PairWriter):
+    """
+    one JSON object per line
+    """
+    def write_batch(self, rows):
+        self.file.write(''.join(json.dumps(OrderedDict(zip(self.fields, row)),
+                                           default=str) + '\n'
+                                for row in rows))
+
+
+class ParquetPairWriter(PairWriter):
+    """
+    Apache Parquet; every batch becomes a row group. Needs pyarrow.
+    """
+    def __init__(self, filename, columns=(), column_types=None):
+        super(ParquetPairWriter, self).__init__(filename, columns, column_types)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('Writing parquet files requires pyarrow '
+                              '(pip install pyarrow).')
+
+        assert filename != 'stdout', 'parquet output needs a file name'
+
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+
+        types = {bool: pyarrow.bool_(), float: pyarrow.float64(),
+                 int: pyarrow.int64(), datetime.date: pyarrow.date32()}
+        fields = [pyarrow.field('positive_accession', pyarrow.string()),
+                  pyarrow.field('negative_accession', pyarrow.string()),
+                  pyarrow.field('distance', pyarrow.float64())]
+        for name in self.fields[3:]:
+            col = name.split('_', 1)[1]
+            fields.append(pyarrow.field(name, types.get(self.column_types.get(col),
+                                                        pyarrow.string())))
+        self.schema = pyarrow.schema(fields)
+
+    def __enter__(self):
+        self.writer = self.pq.ParquetWriter(self.filename, self.schema)
+        return self
+
+    def __exit__(self, exception_type, exception_val, trace):
+        self.writer.close()
+
+    def write_batch(self, rows):
+        arrays = [self.pa.array(list(values), type=field.type)
+                  for values, field in zip(zip(*rows), self.schema)]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+
+PAIR_WRITERS = OrderedDict([
+    ('tsv', TsvPairWriter),
+    ('jsonl', JsonlPairWriter),
+    ('parquet', ParquetPairWriter),
+])
+
+
+def write_pairs(pairs, writer, labels, fetch_metadata=None, batch_size=250):
+    """
+    write pairs in batches, joining assembly metadata per batch
+    :param iterable pairs: tuples *(accession1, accession2, distance)*
+    :param PairWriter writer: an entered PairWriter
+    :param dict labels: {accession: label}, decides which partner is positive
+    :param fetch_metadata: function taking a list of accessions and returning
+                           a dict {accession: tuple of values of writer.columns}
+    :param int batch_size: number of pairs per batch
+    :return int: number of written pairs
+    """
+    empty = (None,) * len(writer.columns)
+    count = 0
+    batch = []
+
+    def flush():
+        if writer.columns and fetch_metadata is not None:
+            accessions = list(set(acc for pair in batch for acc in pair[:2]))
+            metadata = fetch_metadata(accessions)
+        else:
+            metadata = {}
+
+        rows = []
+        for acc1, acc2, dist in batch:
+            if labels.get(acc1):
+                pos, neg = acc1, acc2
+            else:
+                pos, neg = acc2, acc1
+            rows.append((pos, neg, dist) + metadata.get(pos, empty) + metadata.get(neg, empty))
+        writer.write_batch(rows)
+
+    for pair in pairs:
+        batch.append(pair)
+        if len(batch) >= batch_size:
+            flush()
+            count += len(batch)
+            batch = []
+
+    if batch:
+        flush()
+        count += len(batch)
+
+    return count
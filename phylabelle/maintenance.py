@@ -1,14 +1,20 @@
 #!/usr/bin/env python
 
+import calendar
 import gzip
+import json
 import os
 import sys
+import time
 import warnings
 from cStringIO import StringIO
 from collections import defaultdict
 from ftplib import FTP
 
-from phylabelle.orm import Assembly
+from sqlalchemy import Column, String, Boolean, select, func, and_, exists
+
+from phylabelle.orm import Assembly, BATCH_SIZE, assemblies, rejected_assemblies, nucleotides, \
+    temporary_table, insert_rows, accession_table
 from phylabelle.utils import parse_bool
 
 
@@ -94,17 +100,31 @@ class FTPConnector(object):
 
         self.ftp.cwd(_dir)
 
-    def get_file(self, source_filename, target_filename, decompress=False):
+    def get_stat(self, source_filename):
+        """
+        size and modification time of a remote file (FTP SIZE and MDTM)
+        :param str source_filename: filename / relative path to current remote directory
+        :return tuple: size in bytes, modification time in seconds since the epoch
+        """
+        self.ftp.voidcmd('TYPE I')
+        size = self.ftp.size(source_filename)
+        # e.g. '213 20150630123456'
+        mdtm = self.ftp.sendcmd('MDTM {}'.format(source_filename)).split()[1][:14]
+        mtime = calendar.timegm(time.strptime(mdtm, '%Y%m%d%H%M%S'))
+        return size, mtime
+
+    def get_file(self, source_filename, target_filename, decompress=False, overwrite=False):
         """
         retrieve a file from the ftp repository
         :param str source_filename: filename / relative path to current remote directory
         :param str target_filename: rename downloaded file
         :param bool decompress: decompress gzip compressed files
+        :param bool overwrite: download, even if target_filename exists
         """
         cmd = 'RETR {}'.format(source_filename)
         self.buf.clear()
 
-        if not os.path.isfile(target_filename):
+        if overwrite or not os.path.isfile(target_filename):
             # print 'Downloading: {}'.format(source_filename)
             self.ftp.retrbinary(cmd, self.buf.store)
 
@@ -114,27 +134,75 @@ class FTPConnector(object):
                 self.buf.write(target_filename)
 
 
-def update_indices(settings):
+def read_meta(filename):
+    """
+    :param str filename: local copy of a remote file
+    :return dict: content of the sidecar file written by write_meta; empty,
+                  if there is none
+    """
+    try:
+        with open(filename + '.meta', 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_meta(filename, **meta):
     """
-    update assembly-indices from ncbi
+    store information about a local copy of a remote file (e.g. remote size
+    and modification time) in a sidecar file filename.meta
+    :param str filename:
     """
-    print 'Updating assembly summaries... '
-    rs_tab = os.path.join('data', settings.REFSEQ_TABLE)
-    gb_tab = os.path.join('data', settings.GENBANK_TABLE)
+    with open(filename + '.meta', 'w') as f:
+        json.dump(meta, f)
+
 
-    rs_source = settings.FTP_SOURCES[settings.REFSEQ_TABLE]
-    gb_source = settings.FTP_SOURCES[settings.GENBANK_TABLE]
+def is_stale(filename, max_age):
+    """
+    :param str filename: local copy of a remote file
+    :param max_age: seconds, see settings.SUMMARY_MAX_AGE
+    :return bool: True, if the remote file should be checked for updates
+    """
+    if not os.path.isfile(filename):
+        return True
+    if max_age is None:
+        return False
 
-    with FTPConnector(settings.FTP_REPOSITORY, user='anonymous',
-                      passwd=settings.EMAIL) as conn:
-        conn.get_file(rs_source, rs_tab)
-        print '    {}\t[OK]'.format(rs_tab)
-        rs_tab = os.path.abspath(rs_tab)
+    checked = read_meta(filename).get('checked', 0)
+    return time.time() - checked >= max_age
 
-        conn.get_file(gb_source, gb_tab)
-        print '    {}\t[OK]'.format(gb_tab)
-        gb_tab = os.path.abspath(gb_tab)
 
+def update_indices(settings, force=False):
+    """
+    update assembly-indices from ncbi. A summary is downloaded only, if its
+    remote size or modification time differs from the local copy; remote
+    files are not checked more often than settings.SUMMARY_MAX_AGE allows.
+    :param module settings:
+    :param bool force: check remote files regardless of SUMMARY_MAX_AGE
+    :return tuple: paths to genbank and refseq summary
+    """
+    max_age = getattr(settings, 'SUMMARY_MAX_AGE', 0)
+    tables = [(os.path.join('data', name), settings.FTP_SOURCES[name])
+              for name in (settings.GENBANK_TABLE, settings.REFSEQ_TABLE)]
+    stale = [(target, source) for target, source in tables
+             if force or is_stale(target, max_age)]
+
+    if stale:
+        print 'Updating assembly summaries... '
+        with FTPConnector(settings.FTP_REPOSITORY, user='anonymous',
+                          passwd=settings.EMAIL) as conn:
+            for target, source in stale:
+                size, mtime = conn.get_stat(source)
+                meta = read_meta(target)
+                changed = not os.path.isfile(target) or \
+                    (meta.get('size'), meta.get('mtime')) != (size, mtime)
+
+                if changed:
+                    conn.get_file(source, target, overwrite=True)
+                write_meta(target, size=size, mtime=mtime, checked=time.time())
+                print '    {}\t[{}]'.format(target, 'OK' if changed else 'unchanged')
+
+    gb_tab, rs_tab = [os.path.abspath(target) for target, source in tables]
     return gb_tab, rs_tab
 
 
@@ -158,45 +226,148 @@ class RemoteError(Exception):
         pass
 
 
-def update_labels(filename, session):
+def _iter_label_rows(filename):
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            acc, label = line.split('\t')
+            yield {'accession': acc, 'label': parse_bool(label)}
+
+
+def update_labels(filename, session, batch_size=BATCH_SIZE):
     """
-    Update labels
+    Update labels. The file is streamed into a temporary table, labels are
+    then applied by a single UPDATE. If an accession occurs more than once,
+    its last label is used.
     :param filename: file, containing new labels
     :param session: session
-    :return: None
+    :param int batch_size: number of lines per insert into the temporary table
+    :return tuple: number of updated, unchanged and unknown accessions
     """
-    with open(filename, 'r') as f:
-        for line in f:
-            acc, label = line.strip().split('\t')
-            label = parse_bool(label)
+    connection = session.connection()
+
+    with temporary_table(connection, 'tmp_labels',
+                         Column('accession', String(20), primary_key=True),
+                         Column('label', Boolean)) as tmp:
+        insert_rows(connection, tmp, _iter_label_rows(filename), batch_size=batch_size,
+                    prefix='OR REPLACE')
+
+        unknown = connection.execute(
+            select([func.count()]).select_from(tmp).where(
+                ~tmp.c.accession.in_(select([assemblies.c.accession])))).scalar()
 
-            asm = session.query(Assembly).get(acc)
-            asm.label = label
+        new_label = select([tmp.c.label]).where(
+            tmp.c.accession == assemblies.c.accession).as_scalar()
+        changed = exists().where(and_(tmp.c.accession == assemblies.c.accession,
+                                      tmp.c.label.isnot(assemblies.c.label)))
+        updated = connection.execute(
+            assemblies.update().values(label=new_label).where(changed)).rowcount
 
-            session.add(asm)
+        total = connection.execute(select([func.count()]).select_from(tmp)).scalar()
 
     session.commit()
 
+    return updated, total - updated - unknown, unknown
+
+
+class AssemblyWriter(object):
+    """
+    Inserts assemblies with their other_assemblies and nucleotides rows in
+    batches, using executemany instead of the ORM's unit of work. Assemblies
+    whose accession exists already are skipped together with their
+    other_assemblies and nucleotides rows, so existing records are left as
+    they are. Every batch is committed, so an interrupted run keeps its
+    progress.
+
+    .. code-block:: python
+
+        with AssemblyWriter(session) as writer:
+            writer.add(*Assembly.rows_from_proto(proto_asm, metadata, files))
+        print writer.inserted, writer.skipped
+    """
+    def __init__(self, session, batch_size=BATCH_SIZE):
+        """
+        :param session: sqlalchemy session
+        :param int batch_size: number of assemblies per batch
+        """
+        self.session = session
+        self.batch_size = batch_size
+        self.inserted = 0
+        self.skipped = 0
+        # (row, others, nucleotide_rows) of each added assembly
+        self._batch = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_val, trace):
+        self.flush()
+
+    def add(self, row, others=(), nucleotide_rows=()):
+        """
+        :param dict row: row of assemblies
+        :param iterable others: rows of other_assemblies
+        :param iterable nucleotide_rows: rows of nucleotides
+        """
+        self._batch.append((row, others, nucleotide_rows))
+
+        if len(self._batch) >= self.batch_size:
+            self.flush()
 
-def add_assemblies(source, session):
+    def flush(self):
+        """
+        insert and commit buffered rows
+        """
+        if not self._batch:
+            return
+
+        connection = self.session.connection()
+        with accession_table(connection, (row['accession'] for row, _, _ in self._batch)) as tmp:
+            existing = set(acc for acc, in connection.execute(
+                select([assemblies.c.accession]).select_from(
+                    assemblies.join(tmp, tmp.c.accession == assemblies.c.accession))))
+
+        rows = {assemblies: [], rejected_assemblies: [], nucleotides: []}
+        for row, others, nucleotide_rows in self._batch:
+            # existing assemblies, and repeated ones within the batch
+            if row['accession'] in existing:
+                self.skipped += 1
+                continue
+            existing.add(row['accession'])
+            rows[assemblies].append(row)
+            rows[rejected_assemblies].extend(others)
+            rows[nucleotides].extend(nucleotide_rows)
+
+        self.inserted += len(rows[assemblies])
+        self._batch = []
+
+        for table in (assemblies, rejected_assemblies, nucleotides):
+            if rows[table]:
+                connection.execute(table.insert().prefix_with('OR IGNORE'), rows[table])
+
+        self.session.commit()
+
+
+def add_assemblies(source, session, batch_size=BATCH_SIZE):
     """
     adds assemblies to db withou triggering any downloads
     :param source: iterable of proto assemblies
     :param session: sqlalchemy session
+    :param int batch_size: number of assemblies per insert
+    :return AssemblyWriter: holds counts of inserted and skipped assemblies
     """
-    existing_accessions = set([x[0] for x in session.query(Assembly.accession).all()])
-    for proto_asm in source:
-        try:
-            score, acc, metadata = proto_asm.assemblies[0]
-        except IndexError:
-            continue
+    with AssemblyWriter(session, batch_size=batch_size) as writer:
+        for proto_asm in source:
+            try:
+                score, acc, metadata = proto_asm.assemblies[0]
+            except IndexError:
+                continue
 
-        asm = Assembly.from_proto(proto_asm, metadata, [])
-        if asm.accession not in existing_accessions:
-            session.add(asm)
-            existing_accessions.add(asm.accession)
+            writer.add(*Assembly.rows_from_proto(proto_asm, metadata, []))
 
-    session.commit()
+    return writer
 
 
 class Downloader(object):
@@ -206,6 +377,8 @@ class Downloader(object):
         :param bool force_overwrite: if true, all files will be downloaded, regardless whether
                                      they already exist or not, i.e. if this is set to False,
                                      the download process will be reentrant
+
+        Assemblies are written in batches of settings.DB_BATCH_SIZE.
         """
         self.source = source
         self.target_dir = target_dir
@@ -216,11 +389,15 @@ class Downloader(object):
         self.existing_metafiles = list_dir(os.path.join(target_dir, settings.DIRECTORIES['proteomes']))
         self.force_overwrite = force_overwrite
         self.settings = settings
+        self.batch_size = getattr(settings, 'DB_BATCH_SIZE', BATCH_SIZE)
 
     def run(self):
+        with AssemblyWriter(self.session, batch_size=self.batch_size) as writer:
+            self._run(writer)
 
-        existing_accessions = set([x[0] for x in self.session.query(Assembly.accession).all()])
+        return writer
 
+    def _run(self, writer):
         total = len(self.source)
 
         sys.stdout.write('Downloading proteomes\n')
@@ -240,11 +417,8 @@ class Downloader(object):
                             continue
 
                         if not (any(self.check_components(acc)) or self.force_overwrite):
-                            if acc not in existing_accessions:
-                                paths = self.existing_seqfiles[acc] + self.existing_metafiles[acc]
-                                asm = Assembly.from_proto(proto_asm, metadata, paths)
-                                self.session.add(asm)
-                                existing_accessions.add(asm.accession)
+                            paths = self.existing_seqfiles[acc] + self.existing_metafiles[acc]
+                            writer.add(*Assembly.rows_from_proto(proto_asm, metadata, paths))
 
                             break
 
@@ -297,10 +471,7 @@ class Downloader(object):
                                     warnings.warn(e)
                                     raise IncompleteAssemblyException
 
-                            asm = Assembly.from_proto(proto_asm, metadata, paths)
-                            if asm.accession not in existing_accessions:
-                                self.session.add(asm)
-                                existing_accessions.add(asm.accession)
+                            writer.add(*Assembly.rows_from_proto(proto_asm, metadata, paths))
 
                             break
 
@@ -324,8 +495,6 @@ class Downloader(object):
                 else:
                     sys.stdout.write('\n')
 
-        self.session.commit()
-
     def check_components(self, key):
         """
         for a given Assembly-id, check whether sequence-file, assembly-report and feature-table exist.
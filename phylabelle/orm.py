@@ -4,31 +4,49 @@ ORM
 
 Database stuff.
 """
-from sqlalchemy import Table, Column, String, ForeignKey, Date, Boolean
+import os
+import re
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import partial
+
+from sqlalchemy import Table, Column, String, ForeignKey, Date, Boolean, Integer, Float, \
+    MetaData, Index, select, create_engine, event, inspect, text, literal_column, func
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import mapper, relationship
+from sqlalchemy.orm import mapper, relationship, object_session
 
 from phylabelle.fileio import format_get_lines
 
 # store mappings in dict:
 mappings = {}
 
+#: engines by database file, see get_engine
+_engines = {}
+
+#: full-text search index over assemblies, see create_search_index
+SEARCH_TABLE = 'assemblies_fts'
+SEARCH_COLUMNS = ('accession', 'organism_name', 'infraspecific_name', 'species_name')
+
+#: number of rows per executemany call and per fetch
+BATCH_SIZE = 1000
+
 Base = declarative_base()
 
 assemblies = Table('assemblies', Base.metadata,
                    # bioproject id
                    Column('accession', String(20), primary_key=True),
-                   Column('label', Boolean),
+                   Column('label', Boolean, index=True),
                    Column('species_name', String(40)),
                    Column('bioproject_labelsource', String(20)),
-                   Column('bioproject', String(20)),
+                   Column('bioproject', String(20), index=True),
                    Column('assembly_name', String(20)),
-                   Column('organism_name', String(100)),
+                   Column('organism_name', String(100), index=True),
                    Column('infraspecific_name', String(100)),
                    Column('version_status', String(20)),
                    # this is the Taxon-ID of the strain, usually not a foreign key
                    Column('tax_id', String(20)),
-                   Column('species_tax_id', String(20)),
+                   Column('species_tax_id', String(20), index=True),
                    Column('assembly_level', String(20)),
                    Column('ftp_source', String(100)),
                    Column('assembly_level', String(30)),
@@ -43,16 +61,400 @@ assemblies = Table('assemblies', Base.metadata,
 rejected_assemblies = Table('other_assemblies', Base.metadata,
                             Column('accession', String(20), primary_key=True),
                             Column('ftp_source', String(20)),
-                            Column('_assembly_acc', String(20), ForeignKey('assemblies.accession'))
+                            Column('_assembly_acc', String(20), ForeignKey('assemblies.accession'),
+                                   index=True)
                             )
 
 nucleotides = Table('nucleotides', Base.metadata,
                     # ID given
                     Column('accession', String(20), primary_key=True),
                     Column('type', String(20)),
-                    Column('_assembly_acc', String(20), ForeignKey('assemblies.accession'))
+                    Column('_assembly_acc', String(20), ForeignKey('assemblies.accession'),
+                           index=True)
+                    )
+
+#: results of previous pair evaluations, see phylabelle.cache
+pair_caches = Table('pair_caches', Base.metadata,
+                    Column('id', Integer, primary_key=True),
+                    Column('tree_path', String(200)),
+                    # sha1 of the tree file
+                    Column('tree_hash', String(40)),
+                    # sha1 of labels and species of the tree's leaves
+                    Column('label_hash', String(40)),
+                    Column('mode', String(10)),
+                    Column('threshold', Float)
                     )
 
+#: local copy of the assembly summaries, see phylabelle.catalog. Rows keep
+#: the order of the summary file in id.
+catalog = Table('catalog', Base.metadata,
+                Column('id', Integer, primary_key=True),
+                # basename of the summary file
+                Column('source', String(50)),
+                Column('accession', String(20)),
+                # hash of the row's values in the summary file, see Catalog.import_summary
+                Column('row_hash', String(16)),
+                # position of the row in the summary file; rows are read in this order
+                Column('line', Integer),
+                Column('bioproject', String(20)),
+                # names as unified by selection.unify_name
+                Column('species_key', String(100)),
+                Column('strain_key', String(100)),
+                Column('gbrs_paired_asm', String(20)),
+                Column('version_status', String(20)),
+                Column('assembly_level', String(30)),
+                Column('submission_date', Date),
+                # components of selection.asm_score, and the score
+                Column('release_ordinal', Integer),
+                Column('version_bonus', Float),
+                Column('level_bonus', Float),
+                Column('score', Float),
+                Column('ftp_source', String(200)),
+                Column('assembly_name', String(100)),
+                Column('tax_id', String(20)),
+                Column('species_tax_id', String(20)),
+                Column('organism_name', String(200)),
+                Column('infraspecific_name', String(200)),
+                Index('ix_catalog_line', 'source', 'line'),
+                Index('ix_catalog_accession', 'source', 'accession'),
+                Index('ix_catalog_bioproject', 'source', 'bioproject'),
+                Index('ix_catalog_names', 'source', 'species_key', 'strain_key')
+                )
+
+#: summary files loaded into catalog, with size and modification time at
+#: the time of the import
+catalog_sources = Table('catalog_sources', Base.metadata,
+                        Column('source', String(50), primary_key=True),
+                        Column('size', Integer),
+                        Column('mtime', Float),
+                        # settings.NAME_ILLEGALS, the keys were unified with
+                        Column('name_illegals', String(200)),
+                        # settings.ASSEMBLY_LEVELS, the scores were computed with
+                        Column('assembly_levels', String(200)),
+                        Column('rows', Integer)
+                        )
+
+#: tables holding data derived from the summary files (see phylabelle.catalog).
+#: If a table of an older version lacks columns, both are dropped and created
+#: anew by upgrade_schema; the summary files are imported again then.
+CATALOG_TABLES = (catalog, catalog_sources)
+
+#: the FTS5 table over assemblies; it is created by create_search_index and
+#: therefore not part of Base.metadata
+search_table = Table(SEARCH_TABLE, MetaData(),
+                     Column('rowid', Integer),
+                     Column('rank', Float),
+                     *[Column(name, String) for name in SEARCH_COLUMNS])
+
+cached_pairs = Table('cached_pairs', Base.metadata,
+                     Column('id', Integer, primary_key=True),
+                     Column('_cache_id', Integer, ForeignKey('pair_caches.id'), index=True),
+                     Column('accession1', String(20)),
+                     Column('accession2', String(20)),
+                     Column('distance', Float)
+                     )
+
+
+def _set_pragmas(dbapi_connection, connection_record, pragmas):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.iteritems():
+        cursor.execute('PRAGMA {}={}'.format(name, value))
+    cursor.close()
+
+
+def get_engine(db_file, pragmas=None):
+    """
+    Engine for a database file. Engines are created once per process and
+    file; every new connection is configured with pragmas, and the schema is
+    upgraded (see upgrade_schema) when the engine is created.
+    :param str db_file: path to sqlite database
+    :param dict pragmas: SQLite pragmas, e.g. {'synchronous': 'NORMAL'}
+                         (see settings.SQLITE_PRAGMAS)
+    :return: sqlalchemy engine
+    """
+    db_file = os.path.abspath(db_file)
+
+    try:
+        return _engines[db_file]
+    except KeyError:
+        pass
+
+    engine = create_engine('sqlite:///{}'.format(db_file), echo=False)
+    if pragmas:
+        event.listen(engine, 'connect', partial(_set_pragmas, pragmas=pragmas))
+
+    upgrade_schema(engine)
+    _engines[db_file] = engine
+
+    return engine
+
+
+def _missing_columns(inspector, table):
+    """
+    :return set: names of columns of table, that the table in the database
+                 lacks; empty, if the table doesn't exist
+    """
+    if table.name not in inspector.get_table_names():
+        return set()
+    existing = set(column['name'] for column in inspector.get_columns(table.name))
+    return set(table.c.keys()) - existing
+
+
+def upgrade_schema(engine):
+    """
+    bring a database created by an older version up to date: create missing
+    tables and missing indexes. Tables and indexes are never dropped, except
+    for the catalog tables (see CATALOG_TABLES). Indexes over columns that
+    an older table lacks are not created.
+    :param engine: sqlalchemy engine
+    :return list: names of created indexes
+    """
+    inspector = inspect(engine)
+    if any(_missing_columns(inspector, table) for table in CATALOG_TABLES):
+        for table in CATALOG_TABLES:
+            table.drop(engine, checkfirst=True)
+        inspector = inspect(engine)
+
+    Base.metadata.create_all(engine)
+
+    created = []
+    for table in Base.metadata.sorted_tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        missing = _missing_columns(inspector, table)
+        for index in table.indexes:
+            if index.name not in existing and not missing.intersection(index.columns.keys()):
+                index.create(engine)
+                created.append(index.name)
+
+    if create_search_index(engine):
+        created.append(SEARCH_TABLE)
+    elif has_search_index(engine) and not search_index_current(engine):
+        # the index refers to assemblies by their implicit rowid, which
+        # VACUUM may renumber
+        rebuild_search_index(engine)
+
+    if created:
+        # update statistics, so that the query planner picks up new indexes
+        engine.execute('ANALYZE')
+
+    return created
+
+
+def create_search_index(engine):
+    """
+    Create the FTS5 table SEARCH_TABLE over SEARCH_COLUMNS of assemblies,
+    unless it exists already. The table doesn't store a copy of the data,
+    it refers to assemblies by rowid and is kept in sync by triggers.
+    :param engine: sqlalchemy engine
+    :return bool: True, if the table has been created; False, if it existed
+                  or SQLite has been compiled without FTS5
+    """
+    if has_search_index(engine):
+        return False
+
+    columns = ', '.join(SEARCH_COLUMNS)
+    new_values = ', '.join('new.{}'.format(col) for col in SEARCH_COLUMNS)
+    old_values = ', '.join('old.{}'.format(col) for col in SEARCH_COLUMNS)
+    delete = "INSERT INTO {table}({table}, rowid, {columns}) " \
+             "VALUES ('delete', old.rowid, {old});".format(table=SEARCH_TABLE, columns=columns,
+                                                           old=old_values)
+    insert = "INSERT INTO {table}(rowid, {columns}) " \
+             "VALUES (new.rowid, {new});".format(table=SEARCH_TABLE, columns=columns,
+                                                 new=new_values)
+
+    with engine.begin() as conn:
+        try:
+            conn.execute("CREATE VIRTUAL TABLE {} USING fts5({}, content='assemblies', "
+                         "content_rowid='rowid')".format(SEARCH_TABLE, columns))
+        except OperationalError:
+            # no FTS5 support
+            return False
+
+        conn.execute("CREATE TRIGGER {0}_insert AFTER INSERT ON assemblies "
+                     "BEGIN {1} END".format(SEARCH_TABLE, insert))
+        conn.execute("CREATE TRIGGER {0}_delete AFTER DELETE ON assemblies "
+                     "BEGIN {1} END".format(SEARCH_TABLE, delete))
+        conn.execute("CREATE TRIGGER {0}_update AFTER UPDATE OF {1} ON assemblies "
+                     "BEGIN {2} {3} END".format(SEARCH_TABLE, columns, delete, insert))
+
+    rebuild_search_index(engine)
+    return True
+
+
+def has_search_index(connection):
+    """
+    :param connection: engine or connection
+    :return bool: True, if the full-text search table exists
+    """
+    return connection.execute(text("SELECT name FROM sqlite_master WHERE name = :name"),
+                              name=SEARCH_TABLE).first() is not None
+
+
+def search_select(columns, query, search_columns=None, from_=assemblies):
+    """
+    select columns of assemblies matching a full-text query, best matches
+    first (see search_expression)
+    :param list columns: columns of the assemblies table
+    :param str query: words to search for
+    :param iterable search_columns: restrict the search to these of SEARCH_COLUMNS
+    :param from_: assemblies, or a join of assemblies with other tables
+    :return: sqlalchemy Select, or None if query contains no words
+    """
+    expression = search_expression(query, search_columns)
+    if expression is None:
+        return None
+
+    return select(columns).select_from(
+        from_.join(search_table, literal_column('assemblies.rowid') == search_table.c.rowid)
+    ).where(literal_column(SEARCH_TABLE).op('MATCH')(expression)).order_by(search_table.c.rank)
+
+
+def search_index_current(engine):
+    """
+    compare the rowids held by the full-text search index with those of
+    assemblies. VACUUM copies rows in rowid order, so renumbered rowids are
+    detected by their count, sum and range, without a rebuild.
+    :param engine: sqlalchemy engine
+    :return bool: False, if the index has to be rebuilt
+    """
+    stats = 'SELECT count(*), sum({0}), min({0}), max({0}) FROM {1}'
+    return tuple(engine.execute(stats.format('rowid', 'assemblies')).first()) == \
+        tuple(engine.execute(stats.format('id', SEARCH_TABLE + '_docsize')).first())
+
+
+def rebuild_search_index(engine):
+    """
+    rebuild the full-text search index from the assemblies table. Only
+    needed, if rowids of assemblies have changed (e.g. by VACUUM).
+    :param engine: sqlalchemy engine
+    """
+    with engine.begin() as conn:
+        conn.execute("INSERT INTO {0}({0}) VALUES ('rebuild')".format(SEARCH_TABLE))
+
+
+def search_expression(query, columns=None):
+    """
+    translate a free text query into an FTS5 expression: every word of the
+    query has to match a token of the assembly, words are matched as prefix.
+    :param str query: e.g. 'escherichia coli k-12'
+    :param iterable columns: restrict the search to these columns
+    :return str: FTS5 expression, None if query contains no words
+    """
+    tokens = re.findall(r'\w+', query, re.UNICODE)
+    if not tokens:
+        return None
+
+    expression = ' '.join('"{}"*'.format(token) for token in tokens)
+    if columns:
+        expression = '{{{}}} : ({})'.format(' '.join(columns), expression)
+
+    return expression
+
+
+@contextmanager
+def temporary_table(connection, name, *columns):
+    """
+    create a temporary table, which exists only for the given connection
+    and is dropped on exit
+    :param connection: database connection, e.g. session.connection()
+    :param str name: table name
+    :param columns: sqlalchemy Columns
+    :return Table:
+    """
+    table = Table(name, MetaData(), *columns, prefixes=['TEMPORARY'])
+    table.drop(connection, checkfirst=True)
+    table.create(connection)
+
+    try:
+        yield table
+    finally:
+        table.drop(connection)
+
+
+def insert_rows(connection, table, rows, batch_size=BATCH_SIZE, prefix='OR IGNORE'):
+    """
+    insert rows with executemany in batches
+    :param connection: database connection
+    :param Table table:
+    :param iterable rows: dicts
+    :param int batch_size:
+    :param str prefix: conflict handling, e.g. 'OR IGNORE' or 'OR REPLACE'
+    :return int: number of rows
+    """
+    insert = table.insert().prefix_with(prefix)
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            connection.execute(insert, batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        connection.execute(insert, batch)
+        count += len(batch)
+
+    return count
+
+
+@contextmanager
+def accession_table(connection, accessions, name='tmp_accessions'):
+    """
+    Temporary table holding a list of accessions, to join against instead
+    of passing the accessions as bound parameters of an IN clause (which is
+    limited to 999 parameters in SQLite). The table exists only for the given
+    connection and is dropped on exit.
+
+    .. code-block:: python
+
+        with accession_table(conn, accessions) as tmp:
+            query = select([assemblies]).select_from(
+                assemblies.join(tmp, tmp.c.accession == assemblies.c.accession))
+
+    :param connection: database connection, e.g. session.connection()
+    :param iterable accessions:
+    :param str name: table name
+    :return Table: table with a single column accession
+    """
+    with temporary_table(connection, name,
+                         Column('accession', String(20), primary_key=True)) as table:
+        insert_rows(connection, table, ({'accession': acc} for acc in accessions))
+        yield table
+
+
+def iter_rows(result, batch_size=BATCH_SIZE):
+    """
+    iterate over the rows of a query result, fetching them in batches
+    :param result: ResultProxy
+    :param int batch_size:
+    """
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
+#: columns loaded into AssemblyRecords
+RECORD_COLUMNS = ('accession', 'label', 'species_tax_id', 'species_name', 'organism_name',
+                  'infraspecific_name')
+
+
+class AssemblyRecord(namedtuple('AssemblyRecord', RECORD_COLUMNS)):
+    """
+    Lightweight, read-only projection of an Assembly, holding the columns
+    needed to evaluate and report pairs
+    """
+    __slots__ = ()
+
+    @property
+    def refseq(self):
+        """
+        :return: boolean, indicating whether asm is a refseq assembly
+        """
+        return 'GCF' in self.accession
+
 
 class Assembly(object):
     """
@@ -80,13 +482,13 @@ class Assembly(object):
         """
         generate Assembly object from proto_assembly and metadata
         :param ProtoAssembly proto_asm:
-        :param dict metadata: metadata from assembly_summary_tables
+        :param AssemblyMetadata metadata: metadata from assembly_summary_tables
         :param iterable files: iterable of filenames associated to assembly
         :return Assembly asm:
         """
         asm = Assembly(metadata['accession'])
         try:
-            asm.label_source_bioproject = proto_asm.bioproj_acc
+            asm.bioproject_labelsource = proto_asm.bioproj_acc
         except AttributeError:
             pass
 
@@ -98,7 +500,7 @@ class Assembly(object):
 
         asm.bioproject = metadata['bioproject']
         asm.assembly_name = metadata['assembly_name']
-        asm.submission_data = metadata['submission_date']
+        asm.submission_date = metadata['submission_date']
         asm.version_status = metadata['version_status']
         asm.assembly_level = metadata['assembly_level']
         asm.ftp_source = metadata['ftp_source']
@@ -119,6 +521,45 @@ class Assembly(object):
 
         return asm
 
+    @classmethod
+    def rows_from_proto(cls, proto_asm, metadata, files):
+        """
+        like from_proto, but generate plain rows for bulk inserts
+        :param ProtoAssembly proto_asm:
+        :param AssemblyMetadata metadata: metadata from assembly_summary_tables
+        :param iterable files: iterable of filenames associated to assembly
+        :return tuple: (row of assemblies, list of rows of other_assemblies,
+                       which are the assemblies of proto_asm that were not chosen)
+        """
+        row = {
+            'accession': metadata['accession'],
+            'label': proto_asm.label,
+            'species_name': getattr(proto_asm, 'species_name', None),
+            'bioproject_labelsource': getattr(proto_asm, 'bioproj_acc', None),
+            'seq_file': None,
+            'report': None,
+            'feature_table': None,
+        }
+        for key in ('bioproject', 'assembly_name', 'submission_date', 'version_status',
+                    'assembly_level', 'ftp_source', 'tax_id', 'species_tax_id',
+                    'organism_name', 'infraspecific_name'):
+            row[key] = metadata[key]
+
+        for file_name in files:
+            if 'protein.faa' in file_name:
+                row['seq_file'] = file_name
+            elif 'report' in file_name:
+                row['report'] = file_name
+            else:
+                row['feature_table'] = file_name
+
+        others = [{'accession': acc, 'ftp_source': other.get('ftp_source'),
+                   '_assembly_acc': row['accession']}
+                  for score, acc, other in proto_asm.assemblies
+                  if acc != row['accession']]
+
+        return row, others
+
     @classmethod
     def iter_all(cls, session, subset=None):
         """
@@ -126,7 +567,7 @@ class Assembly(object):
         :param session: db-session
         :param list subset: list of accessions; load only ids, contained in this list
         """
-        if filter is not None:
+        if subset is not None:
             asms = session.query(cls).filter(cls.accession.in_(subset)).all()
         else:
             asms = session.query(cls).all()
@@ -134,12 +575,41 @@ class Assembly(object):
         return iter(asms)
 
     @classmethod
-    def get_species_index(cls, session):
+    def iter_records(cls, session, subset=None):
+        """
+        iterate over AssemblyRecords; rows are fetched in batches
+        :param session: db-session
+        :param iterable subset: accessions; load only these assemblies
+        """
+        columns = [assemblies.c[name] for name in RECORD_COLUMNS]
+
+        for row in _select_subset(session, columns, subset):
+            yield AssemblyRecord(*row)
+
+    @classmethod
+    def get_species_index(cls, session, subset=None):
         """
         get a dict containing accession as key and species_tax_id as value
+        :param session: db-session
+        :param iterable subset: accessions; restrict the index to these
         :return:
         """
-        return dict(session.query(cls.accession, cls.species_tax_id).all())
+        return dict(_select_subset(session, [assemblies.c.accession,
+                                             assemblies.c.species_tax_id], subset))
+
+    @classmethod
+    def get_columns(cls, session, accessions, columns):
+        """
+        load selected columns for a list of accessions
+        :param session: db-session
+        :param list accessions: assembly accessions; keep this below SQLite's
+                                limit of bound variables (999)
+        :param list columns: names of columns of the assemblies table
+        :return dict: accession -> tuple of values in the order of columns
+        """
+        query = session.query(cls.accession, *[getattr(cls, col) for col in columns])
+        return {row[0]: tuple(row[1:])
+                for row in query.filter(cls.accession.in_(accessions))}
 
     @property
     def refseq(self):
@@ -171,14 +641,44 @@ class Assembly(object):
         :param type_: type of nucleotide
         """
         for nucl in self.nucleotides:
-            if nucl['type'] == type_:
+            if nucl.type == type_:
                 yield nucl
 
     def count_nucleotides(self, type_):
         """
         :param str type_: the type of nucleotide which shall be counted
         """
-        return len(list(self.get_nucleotides(type_)))
+        session = object_session(self)
+        if session is None or 'nucleotides' in self.__dict__:
+            # detached, or the nucleotides are loaded already
+            return len(list(self.get_nucleotides(type_)))
+
+        return session.query(func.count(nucleotides.c.accession)).filter(
+            nucleotides.c._assembly_acc == self.accession,
+            nucleotides.c.type == type_).scalar()
+
+    @classmethod
+    def get_nucleotide_counts(cls, session, type_, subset=None):
+        """
+        count nucleotides of a type for many assemblies in one query.
+        Assemblies without such nucleotides are missing in the result.
+        :param session: db-session
+        :param str type_: type of nucleotide, e.g. 'Plasmid'
+        :param iterable subset: accessions; count only for these assemblies
+        :return dict: accession -> count
+        """
+        counts = nucleotide_counts(type_)
+        columns = [assemblies.c.accession, counts.c.count]
+        query = select(columns).select_from(
+            assemblies.join(counts, counts.c.accession == assemblies.c.accession))
+
+        connection = session.connection()
+        if subset is None:
+            return dict(iter_rows(connection.execute(query)))
+
+        with accession_table(connection, subset) as tmp:
+            query = query.where(assemblies.c.accession.in_(select([tmp.c.accession])))
+            return dict(iter_rows(connection.execute(query)))
 
     @property
     def num_plasmids(self):
@@ -188,6 +688,42 @@ class Assembly(object):
         return self.count_nucleotides('Plasmid')
 
 
+def nucleotide_counts(type_):
+    """
+    grouped count of nucleotides of one type per assembly, to be joined
+    against assemblies (columns accession and count)
+    :param str type_: type of nucleotide, e.g. 'Plasmid'
+    :return: aliased select
+    """
+    return select([nucleotides.c._assembly_acc.label('accession'),
+                   func.count(nucleotides.c.accession).label('count')]).where(
+        nucleotides.c.type == type_).group_by(nucleotides.c._assembly_acc).alias(
+        'nucleotide_counts')
+
+
+def _select_subset(session, columns, subset=None):
+    """
+    select columns of the assemblies table, optionally only for a subset of
+    accessions, which is joined as temporary table
+    :param session: db-session
+    :param list columns: columns of the assemblies table
+    :param iterable subset: accessions
+    :return: iterator over rows
+    """
+    connection = session.connection()
+
+    if subset is None:
+        for row in iter_rows(connection.execute(select(columns))):
+            yield row
+        return
+
+    with accession_table(connection, subset) as tmp:
+        query = select(columns).select_from(
+            assemblies.join(tmp, tmp.c.accession == assemblies.c.accession))
+        for row in iter_rows(connection.execute(query)):
+            yield row
+
+
 class Nucleotide(object):
     def __init__(self, accession, type):
         self.accession = accession
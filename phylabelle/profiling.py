@@ -0,0 +1,159 @@
+# coding: utf-8
+"""
+phylabelle.profiling
+====================
+
+Per-phase instrumentation. A `Profiler` records wall time, cpu time, peak
+memory and item counts for named phases of a run:
+
+.. code-block:: python
+
+    profiler = Profiler()
+    with profiler.phase('read_tree') as phase:
+        root = read_tree(tree_file)
+        phase.count(leaves=len(root))
+
+    profiler.report('stderr')
+
+Code that may or may not be profiled uses `NullProfiler`, which has the same
+interface but does nothing.
+"""
+
+import json
+import resource
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def max_rss():
+    """
+    :return int: peak resident set size of the current process in kB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def cpu_time():
+    """
+    :return float: user + system cpu time of the current process
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Phase(object):
+    """
+    Measurements of a single phase
+    """
+    def __init__(self, name):
+        self.name = name
+        self.wall = 0.
+        self.cpu = 0.
+        self.peak_rss_kb = None
+        self.rss_growth_kb = None
+        self.counts = OrderedDict()
+
+    def count(self, **counts):
+        """
+        record item counts, e.g. ``phase.count(leaves=100)``
+        """
+        self.counts.update(counts)
+
+    def as_dict(self):
+        return OrderedDict([
+            ('phase', self.name),
+            ('wall', self.wall),
+            ('cpu', self.cpu),
+            ('peak_rss_kb', self.peak_rss_kb),
+            ('rss_growth_kb', self.rss_growth_kb),
+            ('counts', self.counts),
+        ])
+
+
+class Profiler(object):
+    """
+    Collects `Phase` measurements in the order the phases were entered.
+    """
+    enabled = True
+
+    def __init__(self, cprofile_phase=None, cprofile_file=None):
+        """
+        :param str cprofile_phase: name of a phase to run under cProfile
+        :param str cprofile_file: the cProfile stats of cprofile_phase are dumped here
+        """
+        self.phases = []
+        self.cprofile_phase = cprofile_phase
+        self.cprofile_file = cprofile_file
+
+    @contextmanager
+    def phase(self, name):
+        """
+        measure the enclosed block as phase name
+        :param str name: phase name
+        :yield Phase:
+        """
+        phase = Phase(name)
+
+        profile = None
+        if self.cprofile_file is not None and name == self.cprofile_phase:
+            import cProfile
+            profile = cProfile.Profile()
+
+        rss = max_rss()
+        cpu = cpu_time()
+        wall = time.time()
+
+        if profile is not None:
+            profile.enable()
+        try:
+            yield phase
+        finally:
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(self.cprofile_file)
+
+            phase.wall = time.time() - wall
+            phase.cpu = cpu_time() - cpu
+            phase.peak_rss_kb = max_rss()
+            phase.rss_growth_kb = phase.peak_rss_kb - rss
+            self.phases.append(phase)
+
+    def as_dict(self):
+        return {'phases': [phase.as_dict() for phase in self.phases]}
+
+    def report(self, target='stderr'):
+        """
+        write the collected measurements
+        :param str target: either 'stderr' for a human readable table, or
+                           the name of a JSON file
+        """
+        if target == 'stderr':
+            sys.stderr.write('{:20} {:>10} {:>10} {:>12} {:>12}  {}\n'.format(
+                'phase', 'wall [s]', 'cpu [s]', 'peak [kB]', 'growth [kB]', 'counts'))
+            for phase in self.phases:
+                counts = ', '.join('{}={}'.format(k, v) for k, v in phase.counts.iteritems())
+                sys.stderr.write('{:20} {:10.3f} {:10.3f} {:12} {:12}  {}\n'.format(
+                    phase.name, phase.wall, phase.cpu, phase.peak_rss_kb,
+                    phase.rss_growth_kb, counts))
+        else:
+            with open(target, 'w') as f:
+                json.dump(self.as_dict(), f, indent=2)
+
+
+class NullProfiler(object):
+    """
+    Drop-in replacement for `Profiler`, which doesn't measure anything
+    """
+    enabled = False
+
+    class _NullPhase(object):
+        def count(self, **counts):
+            pass
+
+    @contextmanager
+    def phase(self, name):
+        yield self._NullPhase()
+
+    def report(self, target='stderr'):
+        pass
@@ -1,17 +1,67 @@
 # coding: utf-8
 
 import datetime
+import logging
+import multiprocessing
 import os
 import warnings
-from collections import defaultdict
+from collections import defaultdict, namedtuple, OrderedDict
 
 from sortedcontainers import SortedSet
 
-from phylabelle.fileio import Table, Header, Line
+from phylabelle.fileio import Table, Header, iter_column_chunks, get_byte_ranges
 from phylabelle.maintenance import update_indices
 from phylabelle.utils import parse_bool, NoBooleanValueException
 
 
+#: columns of the assembly summary tables used by PreProcessor._read_row,
+#: in this order
+SUMMARY_COLUMNS = ('assembly_accession', 'bioproject', 'organism_name', 'infraspecific_name',
+                   'gbrs_paired_asm', 'version_status', 'assembly_level', 'ftp_path',
+                   'seq_rel_date', 'asm_name', 'taxid', 'species_taxid')
+
+logger = logging.getLogger(__name__)
+
+#: fields of AssemblyMetadata
+METADATA_FIELDS = ('accession', 'bioproject', 'assembly_name', 'submission_date',
+                   'version_status', 'assembly_level', 'ftp_source', 'tax_id',
+                   'species_tax_id', 'organism_name', 'infraspecific_name')
+
+#: bytes of a summary file parsed at once, see PreProcessor.read_summaries
+SHARD_SIZE = 1 << 25
+
+#: header of the mapping log, see MappingProcessor.read_gb_index
+MAPPING_LOG_HEADER = ['sum.SpeciesName_plain', 'sum.Strain_plain', 'sum.SpeciesName_unif',
+                      'sum.StrainName_unif', 'sum.Accession', 'sum.Bioproject',
+                      'labelfile.SpeciesName_plain', 'labelfile.Strain_plain',
+                      'labelfile.SpeciesName_unif', 'labelfile.Strain_unif',
+                      'labelfile.Bioproject']
+
+#: lines written to a log file at once
+LOG_BATCH_SIZE = 10000
+
+#: file buffer of log files in bytes
+LOG_BUFFER_SIZE = 1 << 20
+
+#: data shared with forked worker processes, set by PreProcessor.read_summaries
+_shared = {}
+
+
+def _read_summary_shard(task):
+    """
+    parse a range of an assembly summary file; runs inside a worker process
+    :param tuple task: (filename, byte_range)
+    :return tuple: (filename, list of parsed rows, (hits, misses) of the name cache)
+    """
+    filename, byte_range = task
+    accessions, candidates = _shared['filters'][filename]
+    processor = _shared['processor']
+    hits, misses = processor.names.stats()
+    results = processor.read_summary(filename, accessions, candidates, byte_range)
+    new_hits, new_misses = processor.names.stats()
+    return filename, results, (new_hits - hits, new_misses - misses)
+
+
 def get_indices(settings, update=False):
     """
     get absolute paths of current refseq and genbank assembly-lists
@@ -91,6 +141,156 @@ def unify_name(species_name, strain, illegals=None):
     return spec_name, strain
 
 
+#: default size of a NameCache generation
+NAME_CACHE_SIZE = 100000
+
+
+class NameCache(object):
+    """
+    Bounded cache for unify_name, keyed by the raw (species name, strain).
+    Summary tables repeat the same organism names many times.
+
+    Entries are kept in two generations: hits in the old generation are
+    moved to the current one, and when the current generation is full, the
+    old one is dropped. This evicts the least recently used entries in
+    bulk, at the cost of two dict lookups per miss.
+    """
+    def __init__(self, illegals=None, size=NAME_CACHE_SIZE):
+        """
+        :param list illegals: see unify_name
+        :param int size: maximum number of entries per generation
+        """
+        self.illegals = illegals
+        self.size = size
+        self.current = {}
+        self.old = {}
+        self.hits = 0
+        self.misses = 0
+
+    def unify(self, species_name, strain):
+        """
+        :return tuple: unify_name(species_name, strain)
+        """
+        key = (species_name, strain)
+        try:
+            value = self.current[key]
+            self.hits += 1
+            return value
+        except KeyError:
+            pass
+
+        try:
+            value = self.old.pop(key)
+            self.hits += 1
+        except KeyError:
+            value = unify_name(species_name, strain, illegals=self.illegals)
+            self.misses += 1
+
+        if len(self.current) >= self.size:
+            self.old = self.current
+            self.current = {}
+        self.current[key] = value
+
+        return value
+
+    def hit_rate(self):
+        """
+        :return float: fraction of lookups answered from the cache
+        """
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.
+
+    def stats(self):
+        """
+        :return tuple: number of hits and of misses
+        """
+        return self.hits, self.misses
+
+    def add_stats(self, hits, misses):
+        """
+        add lookups counted elsewhere, e.g. by the copy of the cache in a
+        worker process
+        """
+        self.hits += hits
+        self.misses += misses
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def log_stats(self):
+        logger.debug('name cache: %d hits, %d misses (hit rate %.1f%%), %d entries',
+                     self.hits, self.misses, 100 * self.hit_rate(),
+                     len(self.current) + len(self.old))
+
+
+def parse_date(value):
+    """
+    :param str value: date as found in assembly summaries, e.g. 2015/06/30
+    :return datetime.date: None, if value is no valid date
+    """
+    try:
+        return datetime.date(*(int(x) for x in value.split('/')))
+    except:
+        return None
+
+
+class AssemblyScorer(object):
+    """
+    Computes asm_score for batches of summary rows. Assembly levels and
+    version status are looked up in dicts, and release dates are parsed once
+    per distinct value (summaries share a few thousand dates among millions
+    of rows). The results equal those of asm_score.
+    """
+    def __init__(self, assembly_levels, refseq=False):
+        """
+        :param list assembly_levels: see asm_score
+        :param bool refseq: see asm_score
+        """
+        self.levels = {}
+        for i, level in enumerate(assembly_levels):
+            self.levels.setdefault(level, i * 10e5)
+        self.refseq = int(refseq) * 10e7
+        #: release date as in summary -> (datetime.date, ordinal)
+        self.dates = {}
+
+    def get_components(self, rel_date, version_status, asm_level):
+        """
+        :param str rel_date: release date as in the summary tables, e.g. 2015/06/30
+        :param str version_status:
+        :param str asm_level:
+        :return tuple: date, ordinal of date (0 if unknown), bonus for version
+                       status, bonus for assembly level
+        """
+        try:
+            date, ordinal = self.dates[rel_date]
+        except KeyError:
+            date = parse_date(rel_date)
+            ordinal = date.toordinal() if date is not None else 0
+            self.dates[rel_date] = date, ordinal
+
+        try:
+            level = self.levels[asm_level]
+        except KeyError:
+            raise ValueError('{!r} is not in list'.format(asm_level))
+
+        return date, ordinal, int(version_status == 'latest') * 10e6, level
+
+    def score_batch(self, rel_dates, version_statuses, asm_levels):
+        """
+        :param list rel_dates: release dates as in the summary tables
+        :param list version_statuses: (stripped) version status
+        :param list asm_levels:
+        :return tuple: list of dates, list of scores
+        """
+        components = map(self.get_components, rel_dates, version_statuses, asm_levels)
+        refseq = self.refseq
+        dates = [date for date, ordinal, status, level in components]
+        scores = [ordinal + status + level + refseq
+                  for date, ordinal, status, level in components]
+        return dates, scores
+
+
 def asm_score(submission_date, version_status, asm_level, refseq, assembly_levels):
     """
     calculate a score for an assembly, giving higher values to
@@ -151,6 +351,71 @@ class SimpleMappingIndex(object):
             p_asm.add_asm(acc, score, metadata)
 
 
+def get_ngrams(value, n):
+    """
+    :param str value:
+    :param int n:
+    :return set: all substrings of length n
+    """
+    return set(value[i:i + n] for i in xrange(len(value) - n + 1))
+
+
+class StrainIndex(object):
+    """
+    Inverted index over the character n-grams of the strains of ProtoAssemblies
+    (of one species). It finds the ProtoAssemblies whose strain may contain, or
+    be contained in, a given strain (see ProtoAssembly.match_name), without
+    comparing the strain to all of them: a string contains another only if it
+    contains all of its n-grams.
+    """
+    def __init__(self, n=3):
+        """
+        :param int n: length of n-grams
+        """
+        self.n = n
+        self.proto_assemblies = []
+        #: number of distinct n-grams of each ProtoAssembly's strain
+        self.sizes = []
+        #: n-gram -> indices of proto_assemblies
+        self.postings = defaultdict(list)
+        #: ProtoAssemblies with strains shorter than n
+        self.short = []
+
+    def add(self, proto_asm):
+        """
+        :param ProtoAssembly proto_asm:
+        """
+        ngrams = get_ngrams(proto_asm.strain_key, self.n)
+        if not ngrams:
+            self.short.append(proto_asm)
+            return
+
+        i = len(self.proto_assemblies)
+        self.proto_assemblies.append(proto_asm)
+        self.sizes.append(len(ngrams))
+        for ngram in ngrams:
+            self.postings[ngram].append(i)
+
+    def candidates(self, strain):
+        """
+        :param str strain: unified strain name
+        :return list: ProtoAssemblies, that need to be checked with match_name
+        """
+        ngrams = get_ngrams(strain.lower().strip(), self.n)
+        if not ngrams:
+            return self.proto_assemblies + self.short
+
+        counts = defaultdict(int)
+        for ngram in ngrams:
+            for i in self.postings.get(ngram, ()):
+                counts[i] += 1
+
+        # all n-grams of the strain in the ProtoAssembly's one, or vice versa
+        found = [self.proto_assemblies[i] for i, count in counts.iteritems()
+                 if count == len(ngrams) or count == self.sizes[i]]
+        return found + self.short
+
+
 class MappingIndex(object):
     """
     Map bioprojects and organism names to assemblies, and choose best scoring assembly
@@ -158,7 +423,12 @@ class MappingIndex(object):
     Background is, that Bioprojects in general are no unique key for assemblies and
     can even contain multiple organisms.
     """
-    def __init__(self):
+    def __init__(self, fuzzy=False):
+        """
+        :param bool fuzzy: map names also if one strain contains the other
+                           (see ProtoAssembly.match_name), not only if they
+                           are equal
+        """
         # holds a mapping to ProtoAssembly-Objects with bioproject-ids as key
         self.bp_key = defaultdict(lambda: None)
         # two layered mapping
@@ -169,6 +439,12 @@ class MappingIndex(object):
         self.asm_mapping = {}
         self.rs_refs = defaultdict(lambda: set([]))
         self.assemblies = []
+        self.fuzzy = fuzzy
+        # species name -> StrainIndex, if fuzzy
+        self.strain_index = defaultdict(StrainIndex)
+        # assemblies mapped by bioproject, additional mappings by name,
+        # organisms with contradicting labels (see check_integrity)
+        self.counts = {'bioproject': 0, 'name': 0, 'contradictions': 0}
 
     def add_proto_asm(self, proto_asm):
         """
@@ -177,6 +453,8 @@ class MappingIndex(object):
         """
         self.bp_key[proto_asm.bioproj_acc] = proto_asm
         self.name_key[proto_asm.species_name][proto_asm.strain].append(proto_asm)
+        if self.fuzzy and proto_asm.has_strain():
+            self.strain_index[proto_asm.species_name].add(proto_asm)
 
         self.assemblies.append(proto_asm)
 
@@ -212,21 +490,33 @@ class MappingIndex(object):
         proto_asm1 = self.bp_key[bioproject_id]
         proto_asm2 = self.name_key[species_name][strain]
 
-        mapped = set([])
+        # keyed by identity, in the order found, so the result is the same in every run
+        mapped = OrderedDict()
 
         if proto_asm1:
-            mapped.add(proto_asm1)
+            mapped[id(proto_asm1)] = proto_asm1
 
         if len(proto_asm2) > 0:
             for asm in proto_asm2:
                 if asm.has_strain():
-                    mapped.add(asm)
+                    mapped[id(asm)] = asm
+
+        if self.fuzzy and len(strain) > 1 and species_name in self.strain_index:
+            for asm in self.strain_index[species_name].candidates(strain):
+                if asm.match_name(species_name, strain):
+                    mapped[id(asm)] = asm
 
+        mapped = mapped.values()
         for asm in mapped:
             asm.add_asm(acc, score, metadata)
             self.register_ref(rs_ref, asm)
 
-        mapped = list(mapped)
+        if proto_asm1:
+            self.counts['bioproject'] += 1
+            self.counts['name'] += len(mapped) - 1
+        else:
+            self.counts['name'] += len(mapped)
+
         return mapped
 
     def get_mapped(self):
@@ -237,11 +527,13 @@ class MappingIndex(object):
             if len(asm.assemblies) > 0:
                 yield asm
 
-    def check_integrity(self):
+    def check_integrity(self, filename='contradictions.tsv'):
         """
         Check whether mapping process has produced contradicting labels
+        :param str filename: contradicting organisms are written to this file
+        :return int: number of organisms with contradicting labels
         """
-        with Table('contradictions.tsv', 'w',
+        with Table(filename, 'w', buffer_size=LOG_BUFFER_SIZE,
                    header=Header(sep='\t',
                                  list_=['Name',
                                         'Strain',
@@ -252,6 +544,7 @@ class MappingIndex(object):
                                         'Asm.Label'
                                         ])) as tab:
             iter_ = self.iter_names()
+            lines = []
 
             for name, inf_name, asms in iter_:
                 label = None
@@ -260,11 +553,42 @@ class MappingIndex(object):
                         label = asm.label
                     else:
                         if label != asm.label:
+                            self.counts['contradictions'] += 1
                             for asm_ in asms:
-                                tab.write([name, inf_name, asm_.plain_names[0],
-                                           asm_.plain_names[1], asm_.species_name,
-                                           asm_.strain, asm_.label])
+                                lines.append([name, inf_name, asm_.plain_names[0],
+                                              asm_.plain_names[1], asm_.species_name,
+                                              asm_.strain, str(asm_.label)])
                             break
+                if len(lines) >= LOG_BATCH_SIZE:
+                    tab.write_lines(lines)
+                    lines = []
+
+            tab.write_lines(lines)
+
+        return self.counts['contradictions']
+
+
+class AssemblyMetadata(namedtuple('AssemblyMetadata', METADATA_FIELDS)):
+    """
+    Metadata of an assembly from the summary tables, used to create the
+    Assembly later on. Fields can also be read like keys of a dict, e.g.
+    metadata['ftp_source'], but take a fraction of a dict's memory.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return list(self._fields)
+
+    def items(self):
+        return zip(self._fields, self)
 
 
 class KeyTuple(tuple):
@@ -284,10 +608,17 @@ class TrivialProtoAssembly(object):
     Wraps a SortedSet of assemblies.
     One ProtoAssembly is supposed to represent one distinct organism
     """
-    def __init__(self, acc, label):
+    def __init__(self, acc, label, max_candidates=None):
+        """
+        :param str acc: accession
+        :param bool label:
+        :param int max_candidates: keep only this many best scoring assemblies
+                                   (see settings.MAX_CANDIDATES); None keeps all
+        """
         self.accession = acc
         assert type(label) == bool
         self.label = label
+        self.max_candidates = max_candidates
 
         #: supposed to contain tuples of the form
         #: (SCORE, ASSEMBLY_ACCESSION, METADATA)
@@ -299,13 +630,19 @@ class TrivialProtoAssembly(object):
         add reference to actual genbank/refseq assembly, including ftp-source
         :param str acc: accession
         :param int score: assembly-score, indicating which one is best
-        :param dict metadata: optional metadata
+        :param AssemblyMetadata metadata: optional metadata
         :return bool: indicating whether asm has been accepted (i.e.) not already
-        contained in the references-set
+        contained in the references-set, and not outscored by max_candidates others
         """
+        item = KeyTuple((score, acc, metadata))
         old_size = len(self.assemblies)
-        self.assemblies.add(KeyTuple((score, acc, metadata)))
+        self.assemblies.add(item)
         accepted = old_size < len(self.assemblies)
+
+        if self.max_candidates is not None and len(self.assemblies) > self.max_candidates:
+            # drop the lowest scoring assembly; among equal scores, the one added last
+            accepted = accepted and self.assemblies.pop() is not item
+
         return accepted
 
 
@@ -315,8 +652,9 @@ class ProtoAssembly(TrivialProtoAssembly):
     During the download Process it yields the best scoring assemblies until a valid one
     (i.e. one with an associated, complete proteome) occurs.
     """
-    def __init__(self, bioproj_acc, species_name, strain, label, name_illegals=None):
-        super(ProtoAssembly, self).__init__(None, label)
+    def __init__(self, bioproj_acc, species_name, strain, label, name_illegals=None,
+                 max_candidates=None):
+        super(ProtoAssembly, self).__init__(None, label, max_candidates)
 
         self.bioproj_acc = bioproj_acc
         if not len(strain) > 0:
@@ -325,6 +663,9 @@ class ProtoAssembly(TrivialProtoAssembly):
 
         self.species_name, self.strain = unify_name(species_name, strain, illegals=name_illegals)
         self.plain_names = (species_name, strain)
+        # normalized names for match_name
+        self.species_key = self.species_name.lower().strip()
+        self.strain_key = self.strain.lower().strip()
 
     def has_strain(self):
         return len(self.strain) > 1
@@ -343,72 +684,188 @@ class ProtoAssembly(TrivialProtoAssembly):
         :param strain:
         :return:
         """
-        m1 = self.species_name.lower().strip() == species_name.lower().strip()
-        m2 = self.strain.lower().strip() in strain.lower().strip()
-        m3 = strain.lower().strip() in self.strain.lower().strip()
-        return m1 and (m2 or m3)
+        if self.species_key != species_name.lower().strip():
+            return False
+        strain = strain.lower().strip()
+        return self.strain_key in strain or strain in self.strain_key
 
 
 class PreProcessor(object):
     """
     Manager class for mapping names/labels/organisms to assemblies.
     """
-    def __init__(self, label_file, mapping_log, settings, update=False):
+    def __init__(self, label_file, mapping_log, settings, update=False, n_proc=1,
+                 catalog=None):
         """
         :param str label_file: absolute path to file, containing 2 tabs Assembly-Accession and labels
         :param bool update: update assembly summaries
+        :param int n_proc: number of processes parsing the assembly summaries
+        :param catalog: `phylabelle.catalog.Catalog`; if given, the assembly
+                        summaries are imported into it (unless they are
+                        already) and read from there
         """
         self.mapping_index = None
+        self.n_proc = n_proc
+        self.catalog = catalog
+        self.max_candidates = getattr(settings, 'MAX_CANDIDATES', None)
+        self.scorer = AssemblyScorer(settings.ASSEMBLY_LEVELS)
+        self.names = NameCache(settings.NAME_ILLEGALS,
+                               getattr(settings, 'NAME_CACHE_SIZE', NAME_CACHE_SIZE))
         self.read_labels(label_file)
         self.mapping_log = mapping_log
         self.gb_table, self.rs_table = get_indices(settings, update=update)
+        if catalog is not None:
+            catalog.update([self.gb_table, self.rs_table])
         self.assembly_levels = settings.ASSEMBLY_LEVELS
         self.name_illegals = settings.NAME_ILLEGALS
 
     def _read_line(self, line, valid_accessions=None):
-        acc = line['assembly_accession']
+        """
+        like _read_row, for a `Line` of an assembly summary `Table`
+        """
+        return self._read_row(tuple(line[col] for col in SUMMARY_COLUMNS), valid_accessions)
+
+    def _read_row(self, row, valid_accessions=None):
+        """
+        :param tuple row: values of SUMMARY_COLUMNS
+        :param valid_accessions: if given, rows with other accessions raise
+                                 InvalidAssemblyException before anything
+                                 else is parsed
+        :return tuple: bioproject, species, strain, accession, score, refseq
+                       reference, metadata
+        """
         if valid_accessions is not None:
-            if acc not in valid_accessions:
+            if row[0] not in valid_accessions:
                 raise InvalidAssemblyException
 
-        plain_spec = line['organism_name']
-        plain_strain = line['infraspecific_name']
+        return self._read_rows([row])[0]
 
-        spec, strain = unify_name(plain_spec, plain_strain,
-                                  illegals=self.name_illegals)
+    def _read_rows(self, rows, names=None):
+        """
+        parse a batch of rows; dates and scores are computed column-wise
+        :param list rows: tuples of values of SUMMARY_COLUMNS
+        :param list names: unified (species, strain) of rows, if known already
+        :return list: tuples, as returned by _read_row
+        """
+        if names is None:
+            names = [self.names.unify(row[2], row[3]) for row in rows]
 
-        bioproj = line['bioproject']
+        columns = zip(*rows)
+        version_statuses = [version_status.strip() for version_status in columns[5]]
+        dates, scores = self.scorer.score_batch(columns[8], version_statuses, columns[6])
+
+        results = []
+        for row, (spec, strain), version_status, date, score in zip(rows, names,
+                                                                   version_statuses,
+                                                                   dates, scores):
+            acc, bioproj, plain_spec, plain_strain, rs_ref, _, asm_level, \
+                ftp_source, _, asm_name, tax_id, species_tax_id = row
+
+            # store metadata for generation of assembly object later
+            metadata = AssemblyMetadata(acc, bioproj, asm_name, date, version_status,
+                                        asm_level, ftp_source, tax_id, species_tax_id,
+                                        plain_spec, plain_strain)
+            results.append((bioproj, spec, strain, acc, score, rs_ref, metadata))
+
+        return results
+
+    def iter_summary(self, filename, accessions=None, byte_range=None):
+        """
+        iterate over the rows of an assembly summary file
+        :param str filename:
+        :param set accessions: if given, skip rows of other accessions
+        :param tuple byte_range: if given, read only this range of the file
+        :return: iterator over tuples of SUMMARY_COLUMNS
+        """
+        for rows in iter_column_chunks(filename, SUMMARY_COLUMNS, comment_prefix='#', skip=1,
+                                       keys=accessions, byte_range=byte_range):
+            for row in rows:
+                yield row
+
+    def read_summary(self, filename, accessions=None, candidates=None, byte_range=None):
+        """
+        parse the rows of an assembly summary file
+        :param str filename:
+        :param set accessions: if given, skip rows of other accessions
+        :param tuple candidates: (bioprojects, names, species) if given, keep
+                                 only rows whose bioproject is in bioprojects,
+                                 whose (species, strain) is in names or whose
+                                 species is in species
+        :param tuple byte_range: if given, read only this range of the file
+        :return list: tuples, as returned by _read_row
+        """
+        results = []
+        unify = self.names.unify
+        for rows in iter_column_chunks(filename, SUMMARY_COLUMNS, comment_prefix='#', skip=1,
+                                       keys=accessions, byte_range=byte_range):
+            names = [unify(row[2], row[3]) for row in rows]
 
-        rs_ref = line['gbrs_paired_asm']
+            if candidates is not None:
+                bioprojects, name_keys, species = candidates
+                keep = [i for i, name in enumerate(names)
+                        if rows[i][1] in bioprojects or name in name_keys or name[0] in species]
+                rows = [rows[i] for i in keep]
+                names = [names[i] for i in keep]
 
-        version_status = line['version_status'].strip()
-        asm_level = line['assembly_level']
-        ftp_source = line['ftp_path']
+            if rows:
+                results.extend(self._read_rows(rows, names))
 
+        return results
+
+    def _get_shards(self, filename):
+        """
+        :return list: ranges of bytes of a summary file, at least one per
+                      process and at most SHARD_SIZE bytes long (roughly)
+        """
+        return get_byte_ranges(filename, max(self.n_proc,
+                                             os.path.getsize(filename) // SHARD_SIZE + 1))
+
+    def read_summaries(self, tables):
+        """
+        parse several assembly summary files. Each file is split into ranges of
+        lines, so that only the rows of one range are held in memory at once.
+        If n_proc > 1, all ranges of all files are parsed concurrently in a
+        pool of worker processes. With a catalog, rows are queried from it
+        instead; the catalog parses changed files in its own pool on import.
+        :param list tables: tuples (filename, accessions, candidates), see read_summary
+        :return: iterator over tuples (filename, list of parsed rows); in the
+                 order of tables, and of lines within each file
+        """
+        if self.catalog is not None:
+            for filename, accessions, candidates in tables:
+                yield filename, self.catalog.read_summary(filename, accessions, candidates)
+            return
+
+        self.names.reset_stats()
+        if self.n_proc <= 1:
+            for filename, accessions, candidates in tables:
+                for byte_range in self._get_shards(filename):
+                    yield filename, self.read_summary(filename, accessions, candidates,
+                                                      byte_range)
+            self.names.log_stats()
+            return
+
+        _shared.update({
+            'processor': self,
+            'filters': {filename: (accessions, candidates)
+                        for filename, accessions, candidates in tables},
+        })
+        tasks = [(filename, byte_range) for filename, accessions, candidates in tables
+                 for byte_range in self._get_shards(filename)]
+
+        pool = multiprocessing.Pool(processes=self.n_proc)
         try:
-            date = datetime.date(*(int(x) for x in line['seq_rel_date'].split('/')))
+            for filename, results, stats in pool.imap(_read_summary_shard, tasks):
+                self.names.add_stats(*stats)
+                yield filename, results
+            pool.close()
         except:
-            date = None
-
-        score = asm_score(date, version_status, asm_level, False,
-                          assembly_levels=self.assembly_levels)
-
-        # store metadata for generation of assembly object later
-        metadata = {
-            'accession': acc,
-            'bioproject': bioproj,
-            'assembly_name': line['asm_name'],
-            'submission_date': date,
-            'version_status': version_status,
-            'assembly_level': asm_level,
-            'ftp_source': ftp_source,
-            'tax_id': line['taxid'],
-            'species_tax_id': line['species_taxid'],
-            'organism_name': plain_spec,
-            'infraspecific_name': plain_strain,
-        }
-
-        return bioproj, spec, strain, acc, score, rs_ref, metadata
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _shared.clear()
+        self.names.log_stats()
 
     def read_labels(self, label_file):
         """
@@ -428,40 +885,37 @@ class PreProcessor(object):
                     warnings.warn(e.message)
                     continue
 
-                p_asm = TrivialProtoAssembly(acc, label)
+                p_asm = TrivialProtoAssembly(acc, label, self.max_candidates)
                 self.mapping_index.add_proto_asm(p_asm)
 
     def read_gb_index(self):
         """
         iterate over assembly summary file (genbank) and map lines to existing organisms
         """
-        valid_accessions = self.mapping_index.proto_assemblies.keys()
-
-        with Table(self.gb_table, 'r', comment_prefix='#', skip=1) as tab:
-            for i, line in enumerate(tab):
-                try:
-                    bioproj, spec, strain, acc, score, \
-                        rs_ref, metadata = self._read_line(line, valid_accessions)
-
-                    self.mapping_index.map(acc, score, rs_ref, metadata)
-                except InvalidAssemblyException:
-                    continue
+        self.read_indices([self.gb_table])
 
     def read_rs_index(self):
         """
         iterate over assembly summary file (refseq) and map lines to existing organisms
         """
-        valid_accessions = self.mapping_index.proto_assemblies.keys()
+        self.read_indices([self.rs_table])
 
-        with Table(self.rs_table, 'r', comment_prefix='#', skip=1) as tab:
-            for line in tab:
-                try:
-                    bioproj, spec, strain, acc, score, rs_ref, \
-                        metadata = self._read_line(line, valid_accessions)
+    def read_indices(self, tables=None):
+        """
+        map lines of several assembly summary files to existing organisms
+        :param list tables: filenames; genbank and refseq summary by default.
+                            They are read concurrently, if n_proc > 1.
+        """
+        if tables is None:
+            tables = [self.gb_table, self.rs_table]
 
-                    self.mapping_index.map(acc, score, acc, metadata)
-                except InvalidAssemblyException:
-                    continue
+        valid_accessions = set(self.mapping_index.proto_assemblies)
+
+        for filename, results in self.read_summaries([(filename, valid_accessions, None)
+                                                      for filename in tables]):
+            refseq = filename == self.rs_table
+            for bioproj, spec, strain, acc, score, rs_ref, metadata in results:
+                self.mapping_index.map(acc, score, acc if refseq else rs_ref, metadata)
 
     def remove_empty_organisms(self):
         """
@@ -472,23 +926,85 @@ class PreProcessor(object):
                 del asm
 
 
+class MappingLog(object):
+    """
+    Buffered log of the mapping process. Lines are collected and written in
+    batches. With sample < 1, only about this fraction of the lines is kept;
+    the choice is deterministic, so runs on the same input give the same log.
+    """
+    def __init__(self, filename, header, sample=1.0, compress=False):
+        """
+        :param str filename: None disables the log
+        :param list header: column names
+        :param float sample: fraction of lines written, 0 disables the log
+        :param bool compress: write a gzip compressed file, '.gz' is appended
+                              to the filename
+        """
+        self.enabled = filename is not None and sample > 0
+        self.sample = min(sample, 1.0)
+        self.lines = []
+        self.written = 0
+        self.seen = 0
+        self.table = None
+        if self.enabled:
+            if compress and not filename.endswith('.gz'):
+                filename += '.gz'
+            self.table = Table(filename, 'w', header=Header(sep='\t', list_=header),
+                               compress=compress, buffer_size=LOG_BUFFER_SIZE)
+        self.filename = filename
+
+    def __enter__(self):
+        if self.enabled:
+            self.table.__enter__()
+            self.table.write_header()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.enabled:
+            self.flush()
+            self.table.__exit__(exc_type, exc_val, exc_tb)
+
+    def write(self, line):
+        """
+        :param list line: strings, one per column
+        """
+        self.seen += 1
+        # keep a line whenever seen * sample passes the next integer
+        if int(self.seen * self.sample) == self.written:
+            return
+        self.written += 1
+        self.lines.append(line)
+        if len(self.lines) >= LOG_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.table.write_lines(self.lines)
+        self.lines = []
+
+
 class MappingProcessor(PreProcessor):
     """
     MappingProcessor does combined Name and Bioproject mapping. Input files have
     to be tab-seperated files, containing the columns Species, Strain, Bioproject Accession and Label
 
     """
-    def __init__(self, label_file, mapping_log, settings, update=False):
+    def __init__(self, label_file, mapping_log, settings, update=False, n_proc=1,
+                 catalog=None):
         """
         :param str label_file: absolute path to file, containing labels
         :param bool update: update assembly summaries
+        :param int n_proc: number of processes parsing the assembly summaries
+        :param catalog: `phylabelle.catalog.Catalog`, see PreProcessor
         """
         self.mapping_index = None
         self.name_illegals = settings.NAME_ILLEGALS
+        self.fuzzy = getattr(settings, 'FUZZY_STRAIN_MATCHING', False)
+        self.log_sample = getattr(settings, 'MAPPING_LOG_SAMPLE', 1.0)
+        self.log_compress = getattr(settings, 'MAPPING_LOG_COMPRESS', False)
 
         super(MappingProcessor, self).__init__(label_file,
                                                mapping_log, settings,
-                                               update)
+                                               update, n_proc, catalog)
 
     def read_labels(self, label_file):
         """
@@ -498,7 +1014,7 @@ class MappingProcessor(PreProcessor):
         and build up a mapping index
         """
 
-        self.mapping_index = MappingIndex()
+        self.mapping_index = MappingIndex(fuzzy=self.fuzzy)
         with Table(label_file, 'r') as tab:
             head = tab.header.header.keys()
             if not ('Species' in head and 'Strain' in head and
@@ -506,8 +1022,7 @@ class MappingProcessor(PreProcessor):
                 print head
                 raise InvalidFileFormatError
             for line in tab:
-                spec, strain = unify_name(line['Species'], line['Strain'],
-                                          illegals=self.name_illegals)
+                spec, strain = self.names.unify(line['Species'], line['Strain'])
                 bioproj = line['Bioproject Accession']
                 label = None
                 try:
@@ -516,62 +1031,60 @@ class MappingProcessor(PreProcessor):
                     warnings.warn(e.message)
                     continue
 
-                p_asm = ProtoAssembly(bioproj, spec, strain, label)
+                p_asm = ProtoAssembly(bioproj, spec, strain, label,
+                                      max_candidates=self.max_candidates)
                 self.mapping_index.add_proto_asm(p_asm)
 
     def read_gb_index(self):
         """
         iterate over assembly summary file (genbank) and map lines to existing organisms
         """
-        with Table(self.mapping_log, 'w', header=Header(
-                sep='\t',
-                list_=['sum.SpeciesName_plain',
-                       'sum.Strain_plain',
-                       'sum.SpeciesName_unif',
-                       'sum.StrainName_unif',
-                       'sum.Accession', 'sum.Bioproject',
-                       'labelfile.SpeciesName_plain',
-                       'labelfile.Strain_plain',
-                       'labelfile.SpeciesName_unif',
-                       'labelfile.Strain_unif',
-                       'labelfile.Bioproject',
-                       ])) as log:
-            log.write_header()
-            # TODO: rethink / check logging thing
-            with Table(self.gb_table, 'r', comment_prefix='#', skip=1) as tab:
-                for line in tab:
-                    try:
-                        bioproj, spec, strain, acc, score, \
-                            rs_ref, metadata = self._read_line(line, None)
-                    except InvalidAssemblyException:
-                        continue
-
+        with MappingLog(self.mapping_log, MAPPING_LOG_HEADER, sample=self.log_sample,
+                        compress=self.log_compress) as log:
+            for filename, results in self.read_summaries([(self.gb_table, None,
+                                                           self._get_candidates())]):
+                for bioproj, spec, strain, acc, score, rs_ref, metadata in results:
                     mapped = self.mapping_index.map(bioproj, spec, strain,
                                                     acc, score, rs_ref, metadata)
+                    if not log.enabled:
+                        continue
 
                     for asm in mapped:
-                        if asm:
-                            log_line = Line(log.header, [metadata['organism_name'],
-                                                         metadata['infraspecific_name'],
-                                                         spec, strain,
-                                                         acc, bioproj, asm.plain_names[0],
-                                                         asm.plain_names[1], asm.species_name,
-                                                         asm.strain, asm.bioproj_acc])
-                            log.write(log_line)
+                        log.write([metadata['organism_name'], metadata['infraspecific_name'],
+                                   spec, strain, acc, bioproj, asm.plain_names[0],
+                                   asm.plain_names[1], asm.species_name, asm.strain,
+                                   asm.bioproj_acc])
+
+    def read_indices(self, tables=None):
+        """
+        genbank lines are mapped before refseq lines, as refseq assemblies
+        are found via references of mapped genbank assemblies. Hence, the
+        summary files are not read concurrently.
+        :param tables: ignored
+        """
+        self.read_gb_index()
+        self.read_rs_index()
+
+    def _get_candidates(self):
+        """
+        :return tuple: bioprojects, (species, strain) tuples and species, that
+                       MappingIndex.map can map an assembly to
+        """
+        bioprojects = set(bioproj for bioproj, p_asm in self.mapping_index.bp_key.iteritems()
+                          if p_asm)
+        names = set((name, strain) for name, strain, asms in self.mapping_index.iter_names()
+                    if any(asm.has_strain() for asm in asms))
+        # with fuzzy matching, any strain of an indexed species may match
+        species = set(self.mapping_index.strain_index)
+        return bioprojects, names, species
 
     def read_rs_index(self):
         """
         iterate over assembly summary file (refseq) and map lines to existing organisms
         """
-        valid_accessions = self.mapping_index.rs_refs.keys()
-        with Table(self.rs_table, 'r', comment_prefix='#', skip=1) as tab:
-            for line in tab:
-                try:
-                    bioproj, spec, strain, acc, score, \
-                        rs_ref, metadata = self._read_line(line, valid_accessions)
-                except InvalidAssemblyException:
-                    continue
-
+        valid_accessions = set(self.mapping_index.rs_refs)
+        for filename, results in self.read_summaries([(self.rs_table, valid_accessions, None)]):
+            for bioproj, spec, strain, acc, score, rs_ref, metadata in results:
                 for p_asm in self.mapping_index.rs_refs[acc]:
                     p_asm.add_asm(acc, score, metadata)
 
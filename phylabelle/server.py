@@ -0,0 +1,312 @@
+# coding: utf-8
+"""
+phylabelle.server
+=================
+
+Long-running query service. The tree and the assemblies are loaded once, and
+queries are answered over HTTP (on localhost or a unix socket) with JSON
+responses. Requests are handled by a fixed pool of worker threads.
+
+Endpoints:
+
+``/closest?accession=ACC[&mode=MODE][&n=N]``
+    the N closest partners of ACC
+
+``/distance?accession1=ACC1&accession2=ACC2``
+    the distance of two leaves
+
+``/pairs?threshold=T[&mode=MODE][&matching=1][&max=N]``
+    all pairs with distance <= T, or a minimum matching of them
+"""
+
+import BaseHTTPServer
+import json
+import math
+import os
+import Queue
+import SocketServer
+import stat
+import sys
+import threading
+from collections import OrderedDict
+from urlparse import urlparse, parse_qs
+
+from phylabelle.core import NoResultsException
+
+#: number of /pairs results kept in memory
+RESULT_MEMO_SIZE = 16
+
+
+class QueryError(Exception):
+    """
+    Invalid query; message is sent to the client
+    """
+    def __init__(self, message, status=400):
+        super(QueryError, self).__init__(message)
+        self.status = status
+
+
+def asm_to_dict(asm):
+    """
+    :param asm: Assembly
+    :return dict: JSON serializable representation
+    """
+    return OrderedDict([
+        ('accession', asm.accession),
+        ('organism_name', asm.organism_name),
+        ('species_name', asm.species_name),
+        ('infraspecific_name', asm.infraspecific_name),
+        ('label', asm.label),
+    ])
+
+
+class QueryService(object):
+    """
+    Answers queries against one PhyloTree. PhyloTree keeps its results in
+    instance state, so evaluations are serialized with a lock; distance
+    queries don't touch that state and run concurrently.
+    """
+    def __init__(self, phylo_tree):
+        """
+        :param PhyloTree phylo_tree:
+        """
+        self.phylo_tree = phylo_tree
+        self.lock = threading.Lock()
+        self._memo = OrderedDict()
+
+    def _get_leaf(self, accession):
+        # exact lookup only; PhyloTree.find_leaf would also accept substrings
+        leaf = self.phylo_tree.leaf_index.get(accession)
+        if leaf is None:
+            raise QueryError('unknown accession {}'.format(accession), status=404)
+        return leaf
+
+    def closest(self, accession, mode='all', n=1):
+        """
+        :return dict: query assembly and its closest partners
+        """
+        leaf = self._get_leaf(accession)
+
+        with self.lock:
+            try:
+                partners = self.phylo_tree.find_closest_partner(leaf.name, mode=mode,
+                                                                n_results=n)
+            except KeyError:
+                # the query leaf has no partner at all
+                partners = []
+
+        result = []
+        for asm1, asm2, dist in partners:
+            partner = asm2 if asm1.accession == leaf.name else asm1
+            result.append(OrderedDict([('partner', asm_to_dict(partner)),
+                                       ('distance', dist)]))
+
+        try:
+            query = asm_to_dict(self.phylo_tree.assemblies[leaf.name])
+        except KeyError:
+            query = {'accession': leaf.name}
+
+        return OrderedDict([('query', query), ('partners', result)])
+
+    def distance(self, accession1, accession2):
+        """
+        :return dict: both accessions and their distance
+        """
+        leaf1 = self._get_leaf(accession1)
+        leaf2 = self._get_leaf(accession2)
+        dist = self.phylo_tree.root.get_distance(leaf1, leaf2)
+        return OrderedDict([('accession1', accession1), ('accession2', accession2),
+                            ('distance', dist)])
+
+    def pairs(self, threshold, mode='all', matching=False, max_=None):
+        """
+        :return dict: pairs with distance <= threshold, sorted by distance
+        """
+        key = (threshold, mode, matching)
+
+        with self.lock:
+            try:
+                pairs = self._memo.pop(key)
+            except KeyError:
+                self.phylo_tree.evaluate_all_pairs(threshold, mode=mode)
+                try:
+                    if matching:
+                        results = self.phylo_tree.get_minimum_matching()
+                    else:
+                        results = self.phylo_tree.get_closest()
+                except NoResultsException:
+                    results = []
+
+                pairs = []
+                for asm1, asm2, dist in results:
+                    if asm1.label:
+                        pos, neg = asm1, asm2
+                    else:
+                        pos, neg = asm2, asm1
+                    pairs.append(OrderedDict([('positive', asm_to_dict(pos)),
+                                              ('negative', asm_to_dict(neg)),
+                                              ('distance', dist)]))
+
+                if len(self._memo) >= RESULT_MEMO_SIZE:
+                    self._memo.popitem(last=False)
+            self._memo[key] = pairs
+
+        return OrderedDict([('threshold', threshold), ('mode', mode),
+                            ('matching', matching), ('n_pairs', len(pairs)),
+                            ('pairs', pairs[:max_])])
+
+
+def _get_param(params, name, type_=str, default=None):
+    try:
+        value = params[name][0]
+    except KeyError:
+        if default is None:
+            raise QueryError('missing parameter {}'.format(name))
+        return default
+
+    try:
+        return type_(value)
+    except ValueError:
+        raise QueryError('invalid value for {}: {}'.format(name, value))
+
+
+def _get_threshold(params):
+    threshold = _get_param(params, 'threshold', float)
+    if math.isnan(threshold) or math.isinf(threshold):
+        raise QueryError('threshold must be a finite number')
+    return threshold
+
+
+def _get_mode(params):
+    mode = _get_param(params, 'mode', default='all')
+    if mode not in ['all', 'inter', 'intra']:
+        raise QueryError('invalid mode {}'.format(mode))
+    return mode
+
+
+class QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Dispatches GET requests to the server's QueryService
+    """
+    def address_string(self):
+        # unix sockets have no client address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'local'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            sys.stderr.write('{} - - [{}] {}\n'.format(self.address_string(),
+                                                     self.log_date_time_string(),
+                                                     format % args))
+
+    def _respond(self, status, data):
+        self._send(status, json.dumps(data, allow_nan=False))
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        service = self.server.service
+
+        try:
+            if url.path == '/closest':
+                data = service.closest(_get_param(params, 'accession'),
+                                       mode=_get_mode(params),
+                                       n=_get_param(params, 'n', int, default=1))
+            elif url.path == '/distance':
+                data = service.distance(_get_param(params, 'accession1'),
+                                        _get_param(params, 'accession2'))
+            elif url.path == '/pairs':
+                max_ = _get_param(params, 'max', int, default=-1)
+                data = service.pairs(_get_threshold(params),
+                                     mode=_get_mode(params),
+                                     matching=_get_param(params, 'matching', int, default=0) > 0,
+                                     max_=max_ if max_ >= 0 else None)
+            else:
+                raise QueryError('unknown endpoint {}'.format(url.path), status=404)
+            # serialize before sending anything, so a failure still gets a 500
+            body = json.dumps(data, allow_nan=False)
+        except QueryError as e:
+            self._respond(e.status, {'error': str(e)})
+            return
+        except Exception as e:
+            self.log_error('error answering %s: %r', self.path, e)
+            self._respond(500, {'error': 'internal error'})
+            return
+
+        self._send(200, body)
+
+
+class ThreadPoolMixIn(SocketServer.ThreadingMixIn):
+    """
+    Like ThreadingMixIn, but hands requests to a fixed number of worker
+    threads instead of starting a thread per request.
+    """
+    n_threads = 8
+
+    def start_workers(self):
+        self._requests = Queue.Queue(maxsize=self.n_threads * 4)
+        for _ in xrange(self.n_threads):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def _work(self):
+        while True:
+            request, client_address = self._requests.get()
+            self.process_request_thread(request, client_address)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+
+class QueryServer(ThreadPoolMixIn, BaseHTTPServer.HTTPServer):
+    allow_reuse_address = True
+
+
+class UnixQueryServer(ThreadPoolMixIn, SocketServer.UnixStreamServer):
+    pass
+
+
+def serve(phylo_tree, host='127.0.0.1', port=8787, socket_file=None,
+          n_threads=8, quiet=False):
+    """
+    answer queries until interrupted
+    :param PhyloTree phylo_tree:
+    :param str host: interface to listen on
+    :param int port:
+    :param str socket_file: listen on this unix socket instead of host:port
+    :param int n_threads: number of worker threads
+    :param bool quiet: suppress request logging
+    """
+    if socket_file is not None:
+        # remove a socket left behind by a server that has been killed
+        if os.path.exists(socket_file) and stat.S_ISSOCK(os.stat(socket_file).st_mode):
+            os.remove(socket_file)
+        server = UnixQueryServer(socket_file, QueryHandler)
+        address = socket_file
+    else:
+        server = QueryServer((host, port), QueryHandler)
+        address = 'http://{}:{}'.format(host, port)
+
+    server.service = QueryService(phylo_tree)
+    server.quiet = quiet
+    server.n_threads = n_threads
+    server.start_workers()
+
+    print 'Serving on {}'.format(address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_file is not None:
+            os.remove(socket_file)
@@ -36,11 +36,30 @@ directory.
     phylabelle uses an sqlite database for internal storage. This
     variable states the name of the database that is used.
 
+.. describe:: SQLITE_PRAGMAS
+
+    pragmas applied to every database connection. The defaults favor read
+    performance on large catalogs: write-ahead logging (readers are not
+    blocked by a writer), relaxed syncing, a 64 MB page cache and up to
+    256 MB of memory mapped I/O.
+
+.. describe:: DB_BATCH_SIZE
+
+    number of assemblies written to the database per batch, when assemblies
+    are added
+
 .. describe:: REFSEQ_TABLE, GENBANK_TABLE
 
     These values are the names of the local copies that phylabelle makes of the
     summary tables of refseq/genbank.
 
+.. describe:: SUMMARY_MAX_AGE
+
+    seconds, after which the local copies of the summary tables are checked
+    against the FTP repository again. Files are downloaded only if their
+    remote size or modification time has changed. 0 checks on every call of
+    add, None never checks, as long as local copies exist.
+
 .. describe:: NAME_ILLEGALS
 
     In the name mapping process organism names are stripped from certain
@@ -49,6 +68,33 @@ directory.
     that, e.g. escherichia coli K12 and escherichia coli str. K12 refer to the
     same organism.
 
+.. describe:: MAX_CANDIDATES
+
+    number of best scoring assemblies kept per organism during the mapping
+    process. add downloads the best one with a complete proteome, the others
+    are stored as references (other_assemblies). None (the default) keeps all
+    candidates. A bound, e.g. 25, reduces the memory needed for large label
+    files, but an organism is dropped if none of its kept candidates has a
+    complete proteome, and other_assemblies is truncated.
+
+.. describe:: FUZZY_STRAIN_MATCHING
+
+    by default, the mapping process (add --complex) maps an assembly by name,
+    only if species and strain equal those of the label file. If True,
+    strains also match if one contains the other, e.g. K-12 and K-12 MG1655.
+
+.. describe:: NAME_CACHE_SIZE
+
+    the unified names of up to twice this many distinct organism names are
+    cached during the mapping process. Hit rates are logged at debug level.
+
+.. describe:: MAPPING_LOG_SAMPLE, MAPPING_LOG_COMPRESS
+
+    add --complex logs every assembly mapped to an organism of the label file
+    to mapping_log.tsv. MAPPING_LOG_SAMPLE is the fraction of these lines
+    that is written, 0 turns the log off. If MAPPING_LOG_COMPRESS is True,
+    the log is gzip compressed (mapping_log.tsv.gz).
+
 .. describe:: FTP_REPOSITORY
 
     base url of the FTP proteome source
@@ -86,14 +132,44 @@ DIRECTORIES = {
 #: phylabelle uses an sqlite filebased db
 DB = 'data/data.db'
 
+#: pragmas for each sqlite connection; cache_size is given in kB if negative
+SQLITE_PRAGMAS = OrderedDict([
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -65536),
+    ('mmap_size', 268435456),
+    ('temp_store', 'MEMORY'),
+])
+
+#: number of assemblies per insert
+DB_BATCH_SIZE = 1000
+
 #: in the name mapping process organism names are stripped from certain
 #: very common substrings, that are not unique and not necessary in an organism-name.
 #: These are listed here.
 NAME_ILLEGALS = ['sp.', 'subsp.', 'str.', 'serovar', 'strain=']
 
+#: number of candidate assemblies kept per organism, None for all (25 saves memory)
+MAX_CANDIDATES = None
+
+#: map organism names also if one strain contains the other
+FUZZY_STRAIN_MATCHING = False
+
+#: number of unified organism names cached (per generation, see selection.NameCache)
+NAME_CACHE_SIZE = 100000
+
+#: fraction of mapped assemblies written to the mapping log, 0 for none
+MAPPING_LOG_SAMPLE = 1.0
+
+#: gzip compress the mapping log
+MAPPING_LOG_COMPRESS = False
+
 REFSEQ_TABLE = 'assembly_summary_refseq.txt'
 GENBANK_TABLE = 'assembly_summary_genbank.txt'
 
+#: seconds until the summary tables are checked for updates again
+SUMMARY_MAX_AGE = 24 * 60 * 60
+
 
 #: main repository for proteome downloads
 FTP_REPOSITORY = 'ftp.ncbi.nih.gov'
@@ -10,19 +10,25 @@ partitions across the phylogenetic tree.
 """
 
 import argparse
+import logging
 import os
 import shutil
 import sys
 import warnings
+from functools import partial
 
 import tabulate
-from sqlalchemy import create_engine
+from sqlalchemy import select, func, Boolean
 from sqlalchemy.orm import sessionmaker
 
+from phylabelle.batch import TreeBatch
+from phylabelle.cache import PairCache
 from phylabelle.core import PhyloTree, NoResultsException
-from phylabelle.fileio import get_pretty_output, BufferedTable, Header, \
-    create_project_paths, is_valid_project
+from phylabelle.fileio import get_pretty_output, get_support_output, read_labellings, \
+    write_pairs, PAIR_WRITERS, Header, create_project_paths, is_valid_project
 from phylabelle.maintenance import update_labels, add_assemblies
+from phylabelle.orm import BATCH_SIZE
+from phylabelle.profiling import Profiler, NullProfiler
 
 # this enables to use local settings
 sys.path.append(os.getcwd())
@@ -32,6 +38,9 @@ except ImportError as e:
     from phylabelle import settings
 sys.path.remove(os.getcwd())
 
+#: assembly columns of streamed pairs, unless --columns is given
+PAIR_COLUMNS = ['organism_name']
+
 
 def db_connect(subdir=None, init=False):
     """
@@ -39,12 +48,19 @@ def db_connect(subdir=None, init=False):
                                   different from current working directory
     :param bool init: if true, database file will be initialized
     """
+    from phylabelle.orm import get_engine
+
     if subdir is None:
-        conn = 'sqlite:///{}'.format(settings.DB)
+        db_file = settings.DB
     else:
-        conn = 'sqlite:///{}'.format(os.path.join(subdir, settings.DB))
+        db_file = os.path.join(subdir, settings.DB)
 
-    engine = create_engine(conn, echo=False)
+    pragmas = getattr(settings, 'SQLITE_PRAGMAS', None)
+    if pragmas is None:
+        # local settings of projects created by older versions
+        from phylabelle.settings import SQLITE_PRAGMAS as pragmas
+
+    engine = get_engine(db_file, pragmas)
     session = sessionmaker(bind=engine)()
 
     if init:
@@ -93,43 +109,52 @@ def init_orm(engine, session):
     session.close()
 
 
-def print_ls_asm(assemblies, sort_by='Name', pretty=False, show_plasmids=True):
+def print_ls_asm(rows, header, pretty=False, widths=None):
     """
-    print a plain table of assemblies
-    :param iter assemblies: iterable of assemblies
-    :param sort_by:
-    :param pretty:
-    :param show_plasmids:
-    :return:
+    print a table of assemblies, line by line as rows arrive
+    :param iter rows: tuples of values, in the order of header
+    :param list header: column titles
+    :param bool pretty: align columns, instead of printing tab-separated values
+    :param list widths: width of every column, needed if pretty is set
     """
-    # TODO: show plasmids
-    header = Header('\t', list_=settings.LS_ASM_HEADER.keys())
-
-    fmt = []
-
-    for name, attr in settings.LS_ASM_HEADER.iteritems():
-        try:
-            func = eval(settings.LS_ASM_HEADER[name])
-        except:
-            func = None
+    if pretty:
+        fmt = u'  '.join(u'{{:{}}}'.format(width) for width in widths)
+        lines = [fmt.format(*header).rstrip(), u'  '.join(u'-' * width for width in widths)]
+    else:
+        fmt = u'\t'.join([u'{}'] * len(header))
+        lines = [u'\t'.join(header)]
 
-        fmt.append((attr, func))
+    write = sys.stdout.write
+    for line in lines:
+        write(line.encode('utf-8') + '\n')
 
-    with BufferedTable('stdout', 'w', header=header) as tab:
-        if not pretty:
-            tab.write_header()
+    for row in rows:
+        line = fmt.format(*[u'' if val is None else unicode(val) for val in row])
+        if pretty:
+            line = line.rstrip()
+        write(line.encode('utf-8'))
+        write('\n')
 
-        for asm in assemblies:
-            line = []
-            for attr, func in fmt:
-                val = getattr(asm, attr)
-                if func:
-                    val = func(val)
-                line.append(val)
 
-            tab.append(line)
+def get_column_widths(connection, query, header):
+    """
+    width of each column of a query's result, computed by the database
+    :param connection: database connection
+    :param query: sqlalchemy Select
+    :param list header: column titles, the minimum widths
+    :return list: widths
+    """
+    subquery = query.alias()
+    lengths = []
+    for column in subquery.c:
+        if isinstance(column.type, Boolean):
+            # printed as True/False
+            lengths.append(func.max(func.length(column)) + 4)
+        else:
+            lengths.append(func.max(func.length(column)))
 
-        tab.write(sort_by=sort_by, pretty=pretty, consolidate=True)
+    row = connection.execute(select(lengths).select_from(subquery)).first()
+    return [max(len(title), length or 0) for title, length in zip(header, row)]
 
 
 def print_get_pairs(results, sort_by):
@@ -238,7 +263,10 @@ def get_args():
     sp_dict['ls'].add_argument('-q', '--query', type=str, nargs=2,
                                metavar=('FIELD', 'QUERY'),
                                help='list all available organisms, \
-                                        containing QUERY in FIELD')
+                                        containing QUERY in FIELD. Accession, \
+                                        Name and Strain are searched by word \
+                                        prefixes (e.g. "esch col k1") and \
+                                        ranked by relevance')
     sp_dict['ls'].add_argument('--show_fields', action='store_true',
                                default=False,
                                help='show a list of valid fields for --query')
@@ -253,8 +281,15 @@ def get_args():
     sp_dict['ls'].add_argument('-s', '--sort_by', type=str,
                                choices=['Name', 'Accession',
                                         'Assembly Level', 'Label'],
-                               default='Name',
-                               help='sort output')
+                               default=None,
+                               help='sort output (default: Name, for --query \
+                                    results: relevance)')
+    sp_dict['ls'].add_argument('--plasmids', action='store_true', default=False,
+                               help='show the number of plasmids of each assembly')
+    sp_dict['ls'].add_argument('--limit', type=int, default=None, metavar='N',
+                               help='show at most N assemblies')
+    sp_dict['ls'].add_argument('--offset', type=int, default=None, metavar='N',
+                               help='skip the first N assemblies')
 
     sp_dict['get_example'] = subparsers.add_parser('get_example',
                                                    help=get_example.__doc__)
@@ -269,6 +304,12 @@ def get_args():
     sp_dict['add'].add_argument('file', metavar='FILE', type=str, help='input-file')
     sp_dict['add'].add_argument('--no-download', action='store_true', default=False,
                                 help='suppresses downloads.')
+    sp_dict['add'].add_argument('-n', '--n_proc', type=int, default=1,
+                                help='number of processes to use for importing the \
+                                     assembly summaries')
+    sp_dict['add'].add_argument('-v', '--verbose', action='store_true', default=False,
+                                help='report debug messages, e.g. the hit rate of the \
+                                     name cache, on stderr')
 
     mutex_groups['add'] = sp_dict['add'].add_mutually_exclusive_group()
 
@@ -309,12 +350,14 @@ def get_args():
                                      CP(A) = B <=> CP(B) = A')
 
     sp_dict['get'].add_argument('-s', '--sort_by', type=str,
-                                choices=['p_name', 'np_name', 'dist'],
+                                choices=['p_name', 'np_name', 'dist', 'support'],
                                 default='dist',
                                 help='sort output by the name of the \
                                      pathogenic partner, the name of \
                                      the non-pathogenic partner or \
-                                     their distance')
+                                     their distance. If multiple trees \
+                                     are evaluated, pairs can also be \
+                                     sorted by support')
 
     sp_dict['get'].add_argument('-m', '--mode', type=str, default='all',
                                 choices=['intra', 'inter'],
@@ -333,6 +376,51 @@ def get_args():
                                 help='restricts the number \
                                      of pairs to be displayed to the N \
                                      closest.')
+    sp_dict['get'].add_argument('-t', '--trees', type=str, nargs='+', default=None,
+                                metavar='TREE',
+                                help='evaluate these tree files instead of the tree \
+                                     in the phylo directory. If more than one tree is \
+                                     given (e.g. bootstrap replicates), pairs are \
+                                     aggregated over all trees and reported with \
+                                     their support and the mean and variance of \
+                                     their distance')
+    sp_dict['get'].add_argument('-n', '--n_proc', type=int, default=2,
+                                help='number of processes to use for the evaluation \
+                                     of multiple trees')
+    sp_dict['get'].add_argument('-l', '--labellings', type=str, default=None,
+                                metavar='FILE',
+                                help='evaluate several labellings at once. FILE is \
+                                     a tab-separated table with assembly accessions \
+                                     in the first column and one labelling per \
+                                     further column. Pairs are reported for every \
+                                     labelling')
+    sp_dict['get'].add_argument('--no_cache', action='store_true', default=False,
+                                help='do not use or update the cache of evaluated pairs')
+    sp_dict['get'].add_argument('--profile', nargs='?', type=str, default=None,
+                                const='stderr', metavar='FILE',
+                                help='record time, cpu time, peak memory and item \
+                                     counts for every phase of the run. The report \
+                                     is written to stderr, or as JSON to FILE')
+    sp_dict['get'].add_argument('--cprofile', type=str, default=None, metavar='FILE',
+                                help='dump cProfile statistics of the evaluation \
+                                     phase to FILE')
+    sp_dict['get'].add_argument('-f', '--format', type=str, default='table',
+                                choices=['table', 'tsv', 'jsonl', 'parquet'],
+                                help='output format. tsv, jsonl and parquet are \
+                                     streamed in batches and contain accessions, \
+                                     the distance and the assembly columns chosen \
+                                     with --columns. They are sorted by distance. \
+                                     Only for a single tree and not with --query \
+                                     or --mappings')
+    sp_dict['get'].add_argument('--columns', type=str, nargs='*', default=PAIR_COLUMNS,
+                                metavar='COLUMN',
+                                help='assembly columns written for both partners, \
+                                     if --format is not table. Not with --query \
+                                     or --mappings')
+    sp_dict['get'].add_argument('-o', '--output', type=str, default='stdout',
+                                metavar='FILE',
+                                help='write to FILE instead of stdout, if --format \
+                                     is not table. Not with --query or --mappings')
     mutex_groups['get_pairs'] = sp_dict['get'].add_mutually_exclusive_group()
     mutex_groups['get_pairs'].add_argument('-a', '--all', nargs='?',
                                            metavar='THRESHOLD', type=float, const=float('inf'),
@@ -345,6 +433,23 @@ def get_args():
     mutex_groups['get_pairs'].add_argument('--mappings', action='store_true', default=False,
                                            help='get the annotation for the tree')
 
+    sp_dict['serve'] = subparsers.add_parser('serve', help='load the tree once and answer \
+                                                           queries over HTTP')
+    sp_dict['serve'].add_argument('-t', '--trees', type=str, nargs=1, default=None,
+                                  metavar='TREE',
+                                  help='serve this tree file instead of the tree \
+                                       in the phylo directory')
+    sp_dict['serve'].add_argument('--host', type=str, default='127.0.0.1',
+                                  help='interface to listen on')
+    sp_dict['serve'].add_argument('-p', '--port', type=int, default=8787,
+                                  help='port to listen on')
+    sp_dict['serve'].add_argument('--socket', type=str, default=None, metavar='FILE',
+                                  help='listen on a unix socket instead of host and port')
+    sp_dict['serve'].add_argument('--threads', type=int, default=8,
+                                  help='number of worker threads')
+    sp_dict['serve'].add_argument('--quiet', action='store_true', default=False,
+                                  help='do not log requests')
+
     return arg_parser.parse_args()
 
 
@@ -354,15 +459,17 @@ def get_args():
 
 
 def ls(args):
+    from itertools import chain
     import phylabelle.orm as objects
 
     session = db_connect()
 
     if args.labels:
-        data = session.query(objects.Assembly.accession, objects.Assembly.label).all()
+        query = session.query(objects.Assembly.accession, objects.Assembly.label).order_by(
+            objects.Assembly.accession).yield_per(BATCH_SIZE)
         print 'accession\tlabel'
 
-        for acc, label in data:
+        for acc, label in query:
             print '\t'.join([str(acc), str(label)])
         return
 
@@ -370,21 +477,56 @@ def ls(args):
         objects.Assembly.show_fields()
         return
 
-    sort_by = lambda x: getattr(x, settings.LS_ASM_HEADER[args.sort_by])
+    connection = session.connection()
+    table = objects.assemblies
+    header = settings.LS_ASM_HEADER.keys()
+    columns = [table.c[attr] for attr in settings.LS_ASM_HEADER.values()]
+    sort_column = table.c[settings.LS_ASM_HEADER[args.sort_by or 'Name']]
+    accession = table.c.accession
 
-    if args.query is not None:
-        target = getattr(objects.Assembly, settings.LS_ASM_HEADER[args.query[0]])
-        assemblies = sorted(session.query(objects.Assembly).filter(
-            target.ilike('%{}%'.format(args.query[1]))).all(), key=sort_by)
+    if args.plasmids:
+        # counted for all assemblies by one grouped subquery
+        counts = objects.nucleotide_counts('Plasmid')
+        header.append('Plasmids')
+        columns.append(func.coalesce(counts.c.count, 0))
+        table = table.outerjoin(counts, counts.c.accession == objects.assemblies.c.accession)
 
-        if len(assemblies) == 0:
-            print 'No assemblies found, matching the query "{}" in field "{}".'.format(args.query[1], args.query[0])
-            return
+    #: candidate queries, tried in order until one has results
+    queries = []
+
+    if args.query is not None:
+        field = settings.LS_ASM_HEADER[args.query[0]]
+
+        if field in objects.SEARCH_COLUMNS and objects.has_search_index(connection):
+            # ranked full-text search; keep the ranking unless asked to sort
+            search = objects.search_select(columns, args.query[1], [field], from_=table)
+            if search is not None:
+                if args.sort_by is not None:
+                    search = search.order_by(None).order_by(sort_column, accession)
+                queries.append(search)
+
+        # no index, or no token matched: fall back to substring search
+        target = objects.assemblies.c[field]
+        queries.append(select(columns).select_from(table)
+                       .where(target.ilike('%{}%'.format(args.query[1])))
+                       .order_by(sort_column, accession))
     else:
-        assemblies = sorted(session.query(objects.Assembly).all(),
-                            key=sort_by)
+        queries.append(select(columns).select_from(table).order_by(sort_column, accession))
+
+    for query in queries:
+        query = query.limit(args.limit).offset(args.offset)
 
-    print_ls_asm(assemblies, sort_by=args.sort_by, pretty=not args.tsv)
+        rows = objects.iter_rows(connection.execute(query))
+        first = next(rows, None)
+        if first is None:
+            continue
+
+        widths = None if args.tsv else get_column_widths(connection, query, header)
+        print_ls_asm(chain([first], rows), header, pretty=not args.tsv, widths=widths)
+        return
+
+    if args.query is not None:
+        print 'No assemblies found, matching the query "{}" in field "{}".'.format(args.query[1], args.query[0])
 
 
 def init_project(args):
@@ -407,14 +549,131 @@ def init_project(args):
     print 'project {} created'.format(name)
 
 
+def get_pairs_labellings(args, phylo_tree):
+    """
+    get_pairs for several labellings, read from args.labellings
+    :param args: command line arguments
+    :param PhyloTree phylo_tree:
+    """
+    if args.query or args.mappings:
+        print '--query and --mappings are not available for multiple labellings.'
+        return
+
+    if args.format != 'table' or args.columns != PAIR_COLUMNS or args.output != 'stdout':
+        print '--format, --columns and --output are not available for multiple labellings.'
+        return
+
+    labellings = read_labellings(args.labellings)
+
+    if args.all:
+        threshold = args.all
+        matching = args.b
+    else:
+        threshold = float('inf')
+        matching = True
+
+    phylo_tree.evaluate_labellings(threshold, labellings, mode=args.mode)
+
+    with phylo_tree.profiler.phase('output') as phase:
+        n_pairs = 0
+        for name, labels in labellings.iteritems():
+            results = phylo_tree.get_labelling_results(name, matching=matching)
+            if args.max is not None:
+                results = results[:args.max]
+            n_pairs += len(results)
+
+            print '\n{}\n{}'.format(name, '=' * len(name))
+            if len(results) == 0:
+                print 'No Pairs found.'
+                continue
+            get_pretty_output(results, args.sort_by, labels=labels)
+
+        phase.count(pairs=n_pairs)
+
+
+def get_pairs_stream(args, phylo_tree):
+    """
+    get_pairs with streamed output (tsv, jsonl or parquet). Pairs are kept as
+    accessions; only the columns in args.columns are loaded from the
+    database, batch by batch.
+    :param args: command line arguments
+    :param PhyloTree phylo_tree:
+    """
+    from phylabelle.orm import Assembly, assemblies as assemblies_table
+
+    unknown = [col for col in args.columns if col not in assemblies_table.c]
+    if unknown:
+        print 'Unknown columns: {}. Available are: {}'.format(
+            ', '.join(unknown), ', '.join(assemblies_table.c.keys()))
+        return
+
+    column_types = {col: assemblies_table.c[col].type.python_type for col in args.columns}
+    try:
+        writer = PAIR_WRITERS[args.format](args.output, args.columns, column_types)
+    except ImportError as e:
+        print e
+        return
+
+    if args.sort_by != 'dist':
+        warnings.warn('Streamed output is always sorted by distance.')
+
+    if args.all:
+        threshold = args.all
+        matching = args.b
+    else:
+        threshold = float('inf')
+        matching = True
+
+    if args.max is not None and not matching:
+        phylo_tree.evaluate_top_pairs(args.max, threshold, mode=args.mode)
+    else:
+        phylo_tree.evaluate_all_pairs(threshold, mode=args.mode)
+
+    if matching:
+        results = phylo_tree.get_minimum_matching_accessions()
+    else:
+        try:
+            results = phylo_tree.get_closest_accessions()
+        except NoResultsException:
+            results = []
+
+    if args.max is not None:
+        results = results[:args.max]
+
+    fetch_metadata = partial(Assembly.get_columns, phylo_tree.session, columns=args.columns)
+
+    with phylo_tree.profiler.phase('output') as phase:
+        with writer:
+            n_pairs = write_pairs(results, writer, phylo_tree.labels, fetch_metadata)
+        phase.count(pairs=n_pairs)
+
+
 def get_pairs(args, phylo_tree):
     max_ = args.max
+    profiler = phylo_tree.profiler
 
-    if args.all:
+    if args.sort_by == 'support':
+        print '--sort_by support is only available for multiple trees.'
+        return
+
+    if (args.query or args.mappings) and \
+            (args.format != 'table' or args.columns != PAIR_COLUMNS or args.output != 'stdout'):
+        print '--format, --columns and --output are not available with --query or --mappings.'
+        return
+
+    if args.labellings:
+        get_pairs_labellings(args, phylo_tree)
+    elif args.format != 'table':
+        get_pairs_stream(args, phylo_tree)
+    elif args.all:
         threshold = args.all
 
-        phylo_tree.evaluate_all_pairs(threshold,
-                                      mode=args.mode)
+        if max_ is not None and not args.b:
+            # only the max_ closest pairs are shown, no need to find all
+            phylo_tree.evaluate_top_pairs(max_, threshold, mode=args.mode)
+        else:
+            phylo_tree.evaluate_all_pairs(threshold,
+                                          mode=args.mode)
         if args.b:
             results = phylo_tree.get_minimum_matching()
         else:
@@ -424,10 +683,11 @@ def get_pairs(args, phylo_tree):
                 print 'No Pairs found. Maybe try a higher threshold.'
                 return
 
-        if max_ is not None:
-            get_pretty_output(results[:max_], args.sort_by)
-        else:
+        with profiler.phase('output') as phase:
+            if max_ is not None:
+                results = results[:max_]
             get_pretty_output(results, args.sort_by)
+            phase.count(pairs=len(results))
 
     elif args.mappings:
         print 'AssemblyAccession\tLabel\tSpeciesTaxID'
@@ -441,7 +701,9 @@ def get_pairs(args, phylo_tree):
         results = phylo_tree.find_closest_partner(query, mode=args.mode,
                                                   n_results=max_)
 
-        print_query_pairs(query, results)
+        with profiler.phase('output') as phase:
+            print_query_pairs(query, results)
+            phase.count(pairs=len(results))
     else:
         warnings.warn('If no further options are supplied, only a minimum '
                       'matching of all pairs will be shown.'
@@ -450,7 +712,48 @@ def get_pairs(args, phylo_tree):
                                       mode=args.mode)
         results = phylo_tree.get_minimum_matching()
 
-        get_pretty_output(results, args.sort_by)
+        with profiler.phase('output') as phase:
+            get_pretty_output(results, args.sort_by)
+            phase.count(pairs=len(results))
+
+
+def get_pairs_batch(args, batch):
+    """
+    get_pairs for multiple trees
+    :param args: command line arguments
+    :param TreeBatch batch:
+    """
+    if args.query or args.mappings or args.labellings:
+        print '--query, --mappings and --labellings are not available for multiple trees.'
+        return
+
+    if args.format != 'table' or args.columns != PAIR_COLUMNS or args.output != 'stdout':
+        print '--format, --columns and --output are not available for multiple trees.'
+        return
+
+    if args.all:
+        threshold = args.all
+        matching = args.b
+    else:
+        threshold = float('inf')
+        matching = True
+
+    support = batch.run(threshold, mode=args.mode, matching=matching)
+
+    with batch.profiler.phase('output') as phase:
+        get_support_output(batch.format_results(support), args.sort_by,
+                           support.n_trees, max_=args.max)
+        phase.count(pairs=len(support))
+
+
+def serve(args, phylo_tree):
+    """
+    answer queries against phylo_tree until interrupted
+    """
+    from phylabelle.server import serve as serve_queries
+
+    serve_queries(phylo_tree, host=args.host, port=args.port, socket_file=args.socket,
+                  n_threads=args.threads, quiet=args.quiet)
 
 
 def add(args):
@@ -460,11 +763,25 @@ def add(args):
     """
     from phylabelle.selection import MappingProcessor, PreProcessor, InvalidFileFormatError
     from phylabelle.maintenance import Downloader
+    from phylabelle.catalog import Catalog
+
+    # create_project_paths('.')
+    assert is_valid_project(os.getcwd(), settings.DIRECTORIES), 'Setup project structure first ' \
+                                                                '(call phylophlan init)'
+    session = db_connect()
+
+    if args.verbose:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter('%(name)s: %(message)s'))
+        logger = logging.getLogger('phylabelle')
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
 
     if args.complex:
         try:
             processor = MappingProcessor(args.file, mapping_log='./mapping_log.tsv',
-                                         settings=settings, update=True)
+                                         settings=settings, update=True, n_proc=args.n_proc,
+                                         catalog=Catalog(session, settings, n_proc=args.n_proc))
         except InvalidFileFormatError:
             print 'Invalid file format. Make sure that your file has columns ' \
                   '"Species", "Strain", "Bioproject Accession" and "Label"'
@@ -473,29 +790,33 @@ def add(args):
         processor.mapping_index.check_integrity()
         processor.read_rs_index()
         processor.remove_empty_organisms()
+        counts = processor.mapping_index.counts
+        print 'Mapped by bioproject: {}, by name: {}, contradicting labels: {}'.format(
+            counts['bioproject'], counts['name'], counts['contradictions'])
     elif args.update:
-        session = db_connect()
-        update_labels(args.file, session)
+        updated, unchanged, unknown = update_labels(
+            args.file, session, batch_size=getattr(settings, 'DB_BATCH_SIZE', BATCH_SIZE))
+        print 'Labels updated: {}, unchanged: {}, unknown accessions: {}'.format(
+            updated, unchanged, unknown)
         return
 
     else:
         processor = PreProcessor(args.file, mapping_log='./mapping_log.tsv',
-                                 settings=settings, update=True)
-        processor.read_gb_index()
-        processor.read_rs_index()
+                                 settings=settings, update=True, n_proc=args.n_proc,
+                                 catalog=Catalog(session, settings, n_proc=args.n_proc))
+        processor.read_indices()
         processor.remove_empty_organisms()
 
-    # create_project_paths('.')
-    assert is_valid_project(os.getcwd(), settings.DIRECTORIES), 'Setup project structure first ' \
-                                                                '(call phylophlan init)'
-    session = db_connect()
-
     if args.no_download:
-        add_assemblies(processor.mapping_index.assemblies, session)
+        writer = add_assemblies(processor.mapping_index.assemblies, session,
+                                batch_size=getattr(settings, 'DB_BATCH_SIZE', BATCH_SIZE))
     else:
         d = Downloader(processor.mapping_index.assemblies, '.',
                        session, settings)
-        d.run()
+        writer = d.run()
+
+    print 'Added {} assemblies, skipped {} existing ones.'.format(writer.inserted,
+                                                                  writer.skipped)
 
 
 def get_example(args):
@@ -553,19 +874,43 @@ def run():
     # subprogram has to be listed in globals()
     func = globals()[args.subparser]
 
-    if args.subparser == 'get_pairs':
+    if args.subparser in ('get_pairs', 'serve'):
         # in this case a phylogenetic tree gets loaded
-        # list comprehension finds all xml-files in phylo directory
-        tree_files = [os.path.join(settings.DIRECTORIES['phylo'], x)
-                      for x in os.listdir(settings.DIRECTORIES['phylo'])
-                      if '.xml' in x]
+        if args.trees:
+            tree_files = args.trees
+        else:
+            # list comprehension finds all xml-files in phylo directory
+            tree_files = [os.path.join(settings.DIRECTORIES['phylo'], x)
+                          for x in os.listdir(settings.DIRECTORIES['phylo'])
+                          if '.xml' in x]
+
+            assert len(tree_files) < 2, "Multiple phylogenetic trees found, " \
+                                        "select them with --trees"
 
         assert len(tree_files) > 0, "No phylogenetic tree found"
-        assert len(tree_files) < 2, "Multiple phylogenetic trees found"
 
         session = db_connect()
 
-        phylo_tree = PhyloTree(tree_files[0], session=session)
-        func(args, phylo_tree)
+        if getattr(args, 'profile', None) or getattr(args, 'cprofile', None):
+            profiler = Profiler(cprofile_phase='evaluate', cprofile_file=args.cprofile)
+        else:
+            profiler = NullProfiler()
+
+        if len(tree_files) > 1:
+            batch = TreeBatch(tree_files, session=session, n_proc=args.n_proc,
+                              profiler=profiler)
+            get_pairs_batch(args, batch)
+        else:
+            if getattr(args, 'no_cache', False):
+                cache = None
+            else:
+                cache = PairCache(session)
+
+            phylo_tree = PhyloTree(tree_files[0], session=session, profiler=profiler,
+                                   cache=cache)
+            func(args, phylo_tree)
+
+        if getattr(args, 'profile', None):
+            profiler.report(args.profile)
     else:
         func(args)
\ No newline at end of file
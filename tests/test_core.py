@@ -0,0 +1,135 @@
+# coding: utf-8
+"""
+Tests for the pair search in phylabelle.core, run with nosetests.
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+from collections import OrderedDict
+from heapq import nsmallest
+from operator import itemgetter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+import treegen
+from phylabelle.core import PhyloTree
+from phylabelle.orm import AssemblyRecord
+
+
+def make_labellings(accessions, n_labellings, seed=0, none_ratio=0.):
+    """
+    random labellings; some leaves stay unlabeled in each of them
+    :param float none_ratio: fraction of leaves labeled None
+    :return OrderedDict: labelling name -> {accession: label}
+    """
+    rand = random.Random(seed)
+    labellings = OrderedDict()
+    for i in xrange(n_labellings):
+        labels = {}
+        for acc in accessions:
+            value = rand.random()
+            if value < 0.1:
+                continue
+            elif value < 0.1 + none_ratio:
+                labels[acc] = None
+            else:
+                labels[acc] = value < 0.5
+        labellings['labelling{}'.format(i)] = labels
+    return labellings
+
+
+def load_tree(tree_file, labels):
+    """
+    :param dict labels: accession -> label; other leaves are unlabeled
+    """
+    assemblies = dict((acc, AssemblyRecord(acc, label, acc, None, None, None))
+                      for acc, label in labels.iteritems())
+    species_index = dict((acc, acc) for acc in labels)
+    return PhyloTree(tree_file, None, assemblies=assemblies, species_index=species_index)
+
+
+class TestEvaluateLabellings(object):
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def check_labellings(self, shape, n_leaves, threshold, seed, none_ratio=0.):
+        tree = treegen.SyntheticTree(n_leaves, shape=shape, seed=seed)
+        tree_file = os.path.join(self.tmp, '{}_{}.nwk'.format(shape, seed))
+        tree.write_newick(tree_file)
+
+        accessions = [treegen.leaf_name(i) for i in xrange(n_leaves)]
+        labellings = make_labellings(accessions, 3, seed=seed, none_ratio=none_ratio)
+
+        all_labels = dict.fromkeys(accessions)
+        combined = load_tree(tree_file, all_labels).evaluate_labellings(threshold, labellings)
+
+        for name, labels in labellings.iteritems():
+            phylo_tree = load_tree(tree_file, labels)
+            phylo_tree.evaluate_all_pairs(threshold)
+            expected = sorted(phylo_tree.results.get_closest())
+            found = sorted(combined[name].get_closest())
+
+            assert len(expected) > 0
+            assert [pair[:2] for pair in found] == [pair[:2] for pair in expected], \
+                '{} {} seed {}: pairs differ'.format(shape, name, seed)
+            for pair1, pair2 in zip(found, expected):
+                assert abs(pair1[2] - pair2[2]) < 1e-9
+
+    def test_bootstrap(self):
+        for seed in xrange(5):
+            self.check_labellings('bootstrap', 300, 0.3, seed)
+
+    def test_balanced(self):
+        self.check_labellings('balanced', 256, 0.4, 0)
+
+    def test_caterpillar(self):
+        self.check_labellings('caterpillar', 200, 0.3, 0)
+
+    def test_none_labels(self):
+        # None counts as a negative label in both evaluations
+        self.check_labellings('bootstrap', 300, 0.3, 0, none_ratio=0.2)
+
+
+class TestEvaluateTopPairs(object):
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def check_top_pairs(self, tree_file, labels, k, threshold=float('inf')):
+        phylo_tree = load_tree(tree_file, labels)
+        phylo_tree.evaluate_all_pairs(threshold)
+        expected = nsmallest(k, phylo_tree.results.get_closest(), key=itemgetter(2))
+
+        phylo_tree = load_tree(tree_file, labels)
+        phylo_tree.evaluate_top_pairs(k, threshold)
+        found = sorted(phylo_tree.results.get_closest(), key=itemgetter(2))
+
+        assert len(found) == len(expected)
+        for pair1, pair2 in zip(found, expected):
+            assert abs(pair1[2] - pair2[2]) < 1e-9
+
+    def test_synthetic(self):
+        for shape in ('bootstrap', 'balanced', 'caterpillar'):
+            tree = treegen.SyntheticTree(200, shape=shape, seed=0)
+            tree_file = os.path.join(self.tmp, '{}.nwk'.format(shape))
+            tree.write_newick(tree_file)
+
+            accessions = [treegen.leaf_name(i) for i in xrange(200)]
+            labels = make_labellings(accessions, 1)['labelling0']
+            self.check_top_pairs(tree_file, labels, 20)
+            self.check_top_pairs(tree_file, labels, 20, threshold=0.3)
+
+    def test_unary_node(self):
+        tree_file = os.path.join(self.tmp, 'unary.nwk')
+        with open(tree_file, 'w') as f:
+            f.write('(((GCA_1.1:1,GCA_2.1:1):1):1,GCA_3.1:2);\n')
+
+        labels = {'GCA_1.1': True, 'GCA_2.1': False, 'GCA_3.1': False}
+        self.check_top_pairs(tree_file, labels, 5)